@@ -1,16 +1,19 @@
 """Chat and message endpoints."""
 
-import json
-import re
-from typing import List
-
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import StreamingResponse
+import asyncio
+import time
+from typing import AsyncIterator, List, Optional, Set
+
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 
 from app.core.database import get_db, SessionLocal
 from app.core.security import get_current_user
-from app.models import User, Chat, Message, WorkflowState
+from app.models import User, Chat, ChatCollaborator, Message, WorkflowState, WorkflowSnapshot, WorkflowOperation
 from app.schemas import (
     ChatCreate,
     ChatResponse,
@@ -21,18 +24,74 @@ from app.schemas import (
 )
 from app.services.chat import get_chat_with_access
 from app.services.ai import (
-    build_system_message,
-    build_conversation_history,
-    extract_json_workflow,
+    build_prompt_messages,
+    completion_token_limit,
+    finalize_workflow,
     generate_ai_response,
-    WORKFLOW_KEYWORDS,
+    get_openai_client,
+    load_conversation_context,
+    save_ai_message,
 )
-from app.services.workflow import ensure_workflow_state
+from app.services.context_cache import conversation_cache
+from app.services.op_log_cache import op_log_cache
+from app.services.response_cache import ai_response_cache
+from app.services.workflow_state_cache import workflow_state_cache
 from app.websocket import connection_manager, chat_lock_manager
 from app.utils import IncrementalWorkflowParser
 
 router = APIRouter(tags=["chats"])
 
+# Replies generated after a 202 ACK; held so the loop doesn't drop the tasks.
+_reply_tasks: Set[asyncio.Task] = set()
+
+# Coalesce streamed tokens into one text_chunk per ~64 chars or 30 ms.
+TEXT_FLUSH_CHARS = 64
+TEXT_FLUSH_SECONDS = 0.03
+
+
+def _sse(event: str, data: dict) -> str:
+    """Frame one server-sent event."""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+async def _delta_tokens(stream) -> AsyncIterator[str]:
+    """Text deltas of an OpenAI chat completion stream."""
+    async for chunk in stream:
+        choice = chunk.choices[0] if chunk.choices else None
+        if choice and choice.delta and choice.delta.content:
+            yield choice.delta.content
+
+
+async def _stream_reply(messages: List[dict], max_tokens: int) -> AsyncIterator[str]:
+    """
+    Text deltas of a streamed reply. If the model sends nothing but
+    whitespace, retry once, deterministic and shorter, as the non-streamed
+    path does; nothing visible has reached the client yet, so that is safe.
+    """
+    options = {}
+    for _ in range(2):
+        stream = await get_openai_client().chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            max_completion_tokens=max_tokens,
+            stream=True,
+            **options,
+        )
+        empty = True
+        async for token in _delta_tokens(stream):
+            if empty and not token.isspace():
+                empty = False
+            yield token
+        if not empty:
+            return
+        max_tokens //= 2
+        options = {"temperature": 0}
+
+
+async def _replay_tokens(reply: str) -> AsyncIterator[str]:
+    """A cached reply, streamed as a single token."""
+    yield reply
+
 
 @router.get("/chats", response_model=List[ChatResponse])
 def get_chats(
@@ -86,10 +145,38 @@ def create_chat(
 @router.get("/chats/{chat_id}", response_model=ChatWithMessages)
 def get_chat(
     chat_id: int,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    before: Optional[int] = Query(None),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    return get_chat_with_access(chat_id, current_user, db)
+    """
+    The chat with its messages, oldest first. Passing `limit` returns only the
+    newest `limit` of them (older than message `before`, if given); without it
+    every message is returned, as the client does not page yet.
+    """
+    chat = get_chat_with_access(chat_id, current_user, db)
+    query = db.query(Message).filter(Message.chat_id == chat_id)
+    if before is not None:
+        query = query.filter(Message.id < before)
+    query = query.order_by(Message.id.desc())
+    if limit is None:
+        messages = query.all()
+        has_more = False
+    else:
+        # One extra row tells whether older messages remain.
+        messages = query.limit(limit + 1).all()
+        has_more = len(messages) > limit
+        del messages[limit:]
+    messages.reverse()
+    return {
+        "id": chat.id,
+        "title": chat.title,
+        "created_at": chat.created_at,
+        "updated_at": chat.updated_at,
+        "messages": messages,
+        "has_more": has_more,
+    }
 
 
 @router.delete("/chats/{chat_id}")
@@ -98,107 +185,206 @@ def delete_chat(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == current_user.id).first()
-    if not chat:
+    owned_chat = select(Chat.id).where(Chat.id == chat_id, Chat.user_id == current_user.id)
+    # Bulk deletes skip the ORM cascade, and messages have no ON DELETE
+    # CASCADE (nor does SQLite enforce foreign keys by default), so clear
+    # every child table explicitly before the chat itself.
+    for model in (Message, ChatCollaborator, WorkflowOperation, WorkflowSnapshot, WorkflowState):
+        db.query(model).filter(model.chat_id.in_(owned_chat)).delete(synchronize_session=False)
+    deleted = (
+        db.query(Chat)
+        .filter(Chat.id == chat_id, Chat.user_id == current_user.id)
+        .delete(synchronize_session=False)
+    )
+    if not deleted:
+        db.rollback()
         raise HTTPException(status_code=404, detail="Chat not found or you are not the owner")
-    db.delete(chat)
     db.commit()
+    conversation_cache.invalidate(chat_id)
+    op_log_cache.invalidate(chat_id)
+    workflow_state_cache.invalidate(chat_id)
+    ai_response_cache.invalidate(chat_id)
     return {"message": "Chat deleted successfully"}
 
 
+def _add_user_message(chat_id: int, content: str, db: Session) -> Message:
+    """Persist the user's message and title a fresh chat after its first message."""
+    db.expire_all()
+    chat = db.query(Chat).filter(Chat.id == chat_id).first()
+    user_message = Message(chat_id=chat_id, role="user", content=content)
+    db.add(user_message)
+    # The first message always renames the chat, so the placeholder title
+    # alone marks it as fresh; no message count needed.
+    if chat.title == "New Conversation":
+        if len(content) > 50:
+            end = content.rfind(" ", 0, 50)
+            chat.title = content[:50 if end < 0 else end] + "..."
+        else:
+            chat.title = content
+    # Flush for the id, then detach so the commit doesn't expire the row
+    # (no refresh SELECT needed to read it back).
+    db.flush()
+    db.expunge(user_message)
+    db.commit()
+    return user_message
+
+
+def _workflow_version(chat_id: int, db: Session) -> Optional[int]:
+    # save_ai_message refreshes the cache, so this is normally a hit.
+    state = workflow_state_cache.get(chat_id)
+    if state is not None:
+        return state["version"]
+    ws_state = db.query(WorkflowState.version).filter(WorkflowState.chat_id == chat_id).first()
+    return ws_state.version if ws_state else None
+
+
+def _exchange_messages(chat_id: int, user_message: Message, ai_message: Message) -> List[dict]:
+    """The user/assistant pair as sent in new_message and message.completed events."""
+    return [
+        {
+            "id": user_message.id,
+            "chat_id": chat_id,
+            "role": "user",
+            "content": user_message.content,
+            "workflow_data": None,
+            "created_at": user_message.created_at.isoformat(),
+        },
+        {
+            "id": ai_message.id,
+            "chat_id": chat_id,
+            "role": "assistant",
+            "content": ai_message.content,
+            "workflow_data": ai_message.workflow_data,
+            "created_at": ai_message.created_at.isoformat(),
+        },
+    ]
+
+
+async def _reply_in_background(
+    chat_id: int, content: str, user_message: Message, user_id: int, username: str
+) -> None:
+    """Generate and save the assistant reply, then publish it over the chat socket.
+
+    Runs after the request has returned, so it owns its session and releases
+    the chat lock the endpoint acquired.
+    """
+    db = SessionLocal()
+    try:
+        ai_message = await generate_ai_response(chat_id, content, user_message, user_id, username, db)
+        workflow_version = await run_in_threadpool(_workflow_version, chat_id, db)
+        messages = _exchange_messages(chat_id, user_message, ai_message)
+        await connection_manager.broadcast_to_chat(
+            chat_id,
+            {
+                "type": "new_message",
+                "chat_id": chat_id,
+                "sender_id": user_id,
+                "sender_username": username,
+                "workflow_version": workflow_version,
+                "messages": messages,
+            },
+            exclude_user=user_id,
+        )
+        await connection_manager.broadcast_to_chat(
+            chat_id,
+            {
+                "type": "message.completed",
+                "chat_id": chat_id,
+                "user_message_id": user_message.id,
+                "workflow_version": workflow_version,
+                "messages": messages,
+            },
+        )
+    except Exception as e:
+        await connection_manager.broadcast_to_chat(
+            chat_id,
+            {
+                "type": "message.failed",
+                "chat_id": chat_id,
+                "user_message_id": user_message.id,
+                "error": str(e),
+            },
+        )
+    finally:
+        try:
+            db.close()
+        finally:
+            await chat_lock_manager.release(chat_id, connection_manager)
+
+
 @router.post("/chats/{chat_id}/messages", response_model=MessageResponse)
 async def create_message(
     chat_id: int,
     message: MessageCreate,
+    background: bool = Query(False),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    get_chat_with_access(chat_id, current_user, db)
+    # Blocking DB work goes through the threadpool and the OpenAI call is
+    # awaited, so the loop stays free for other requests and sockets.
+    await run_in_threadpool(get_chat_with_access, chat_id, current_user, db)
     await chat_lock_manager.acquire(
         chat_id, current_user.id, current_user.username, connection_manager
     )
+    handed_off = False
     try:
-        db.expire_all()
-        chat = db.query(Chat).filter(Chat.id == chat_id).first()
-        user_message = Message(chat_id=chat_id, role="user", content=message.content)
-        db.add(user_message)
-        db.commit()
-        db.refresh(user_message)
-
-        if chat.title == "New Conversation":
-            message_count = db.query(Message).filter(Message.chat_id == chat_id).count()
-            if message_count == 1:
-                title = message.content[:50]
-                if len(message.content) > 50:
-                    title = title.rsplit(" ", 1)[0] + "..."
-                chat.title = title
-                db.commit()
-
-        ai_message = generate_ai_response(
+        user_message = await run_in_threadpool(_add_user_message, chat_id, message.content, db)
+
+        if background:
+            # ACK now; the reply arrives as a message.completed WS event and
+            # the task takes over releasing the chat lock.
+            task = asyncio.create_task(
+                _reply_in_background(
+                    chat_id, message.content, user_message, current_user.id, current_user.username
+                )
+            )
+            _reply_tasks.add(task)
+            task.add_done_callback(_reply_tasks.discard)
+            handed_off = True
+            return JSONResponse(
+                status_code=202,
+                content={"status": "queued", "chat_id": chat_id, "user_message_id": user_message.id},
+            )
+
+        ai_message = await generate_ai_response(
             chat_id, message.content, user_message, current_user.id, current_user.username, db
         )
-        ws_state = db.query(WorkflowState).filter(WorkflowState.chat_id == chat_id).first()
-        await connection_manager.broadcast_to_chat(
+        workflow_version = await run_in_threadpool(_workflow_version, chat_id, db)
+        connection_manager.broadcast_in_background(
             chat_id,
             {
                 "type": "new_message",
                 "chat_id": chat_id,
                 "sender_id": current_user.id,
                 "sender_username": current_user.username,
-                "workflow_version": ws_state.version if ws_state else None,
-                "messages": [
-                    {
-                        "id": user_message.id,
-                        "chat_id": chat_id,
-                        "role": "user",
-                        "content": user_message.content,
-                        "workflow_data": None,
-                        "created_at": user_message.created_at.isoformat(),
-                    },
-                    {
-                        "id": ai_message.id,
-                        "chat_id": chat_id,
-                        "role": "assistant",
-                        "content": ai_message.content,
-                        "workflow_data": ai_message.workflow_data,
-                        "created_at": ai_message.created_at.isoformat(),
-                    },
-                ],
+                "workflow_version": workflow_version,
+                "messages": _exchange_messages(chat_id, user_message, ai_message),
             },
             exclude_user=current_user.id,
         )
         return ai_message
     finally:
-        await chat_lock_manager.release(chat_id, connection_manager)
+        if not handed_off:
+            await chat_lock_manager.release(chat_id, connection_manager)
 
 
 @router.post("/chats/{chat_id}/messages/stream")
 async def stream_message(
     chat_id: int,
     message: MessageCreate,
+    legacy_events: bool = Query(False),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    get_chat_with_access(chat_id, current_user, db)
+    await run_in_threadpool(get_chat_with_access, chat_id, current_user, db)
     await chat_lock_manager.acquire(
         chat_id, current_user.id, current_user.username, connection_manager
     )
-
-    db.expire_all()
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
-    user_message = Message(chat_id=chat_id, role="user", content=message.content)
-    db.add(user_message)
-    db.commit()
-    db.refresh(user_message)
-
-    if chat.title == "New Conversation":
-        message_count = db.query(Message).filter(Message.chat_id == chat_id).count()
-        if message_count == 1:
-            title = message.content[:50]
-            if len(message.content) > 50:
-                title = title.rsplit(" ", 1)[0] + "..."
-            chat.title = title
-            db.commit()
+    try:
+        user_message = await run_in_threadpool(_add_user_message, chat_id, message.content, db)
+    except BaseException:
+        await chat_lock_manager.release(chat_id, connection_manager)
+        raise
 
     user_id = current_user.id
     username = current_user.username
@@ -210,140 +396,90 @@ async def stream_message(
     async def event_generator():
         gen_db = SessionLocal()
         try:
-            yield f"event: stream_start\ndata: {json.dumps({'user_message_id': user_msg_id})}\n\n"
+            yield _sse("stream_start", {"user_message_id": user_msg_id})
 
-            all_messages = (
-                gen_db.query(Message)
-                .filter(Message.chat_id == chat_id)
-                .order_by(Message.created_at)
-                .all()
-            )
-            last_workflow_msg = (
-                gen_db.query(Message)
-                .filter(
-                    Message.chat_id == chat_id,
-                    Message.role == "assistant",
-                    Message.workflow_data.isnot(None),
-                )
-                .order_by(Message.created_at.desc())
-                .first()
+            conversation, workflow_context, last_workflow_data = await run_in_threadpool(
+                load_conversation_context, chat_id, gen_db
             )
-            conversation, workflow_context = build_conversation_history(
-                all_messages, last_workflow_msg
-            )
-            system_msg = build_system_message(workflow_context)
-
-            from openai import AsyncOpenAI
-            from app.core.config import settings
+            # Don't hold a pooled connection for the length of the stream.
+            gen_db.close()
 
-            client = AsyncOpenAI(api_key=settings.openai_api_key, timeout=120.0)
-            stream = await client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[system_msg] + conversation,
-                max_completion_tokens=5000,
-                stream=True,
-            )
+            prompt_messages = build_prompt_messages(conversation, workflow_context)
+            cache_key = ai_response_cache.key(chat_id, prompt_messages)
+            cached_reply = ai_response_cache.get(cache_key)
+            if cached_reply is not None:
+                tokens = _replay_tokens(cached_reply)
+            else:
+                tokens = _stream_reply(
+                    prompt_messages, completion_token_limit(msg_content_lower, workflow_context)
+                )
 
             parser = IncrementalWorkflowParser()
             full_content = ""
+            text_buffer: List[str] = []
+            buffered_chars = 0
+            last_flush = time.monotonic()
 
-            async for chunk in stream:
-                choice = chunk.choices[0] if chunk.choices else None
-                if not choice or not choice.delta or not choice.delta.content:
-                    continue
-                token = choice.delta.content
+            async for token in tokens:
                 full_content += token
-                yield f"event: text_chunk\ndata: {json.dumps({'content': token})}\n\n"
+                text_buffer.append(token)
+                buffered_chars += len(token)
+                now = time.monotonic()
+                if buffered_chars >= TEXT_FLUSH_CHARS or now - last_flush >= TEXT_FLUSH_SECONDS:
+                    yield _sse("text_chunk", {"content": "".join(text_buffer)})
+                    text_buffer.clear()
+                    buffered_chars = 0
+                    last_flush = now
+                if legacy_events:
+                    for kind, item in parser.feed_iter(token):
+                        yield _sse(f"{kind}_add", {kind: item})
+                    continue
                 new_nodes, new_edges = parser.feed(token)
-                for node in new_nodes:
-                    yield f"event: node_add\ndata: {json.dumps({'node': node})}\n\n"
-                for edge in new_edges:
-                    yield f"event: edge_add\ndata: {json.dumps({'edge': edge})}\n\n"
+                if new_nodes or new_edges:
+                    yield _sse("graph_delta", {"nodes": new_nodes, "edges": new_edges})
+
+            if text_buffer:
+                yield _sse("text_chunk", {"content": "".join(text_buffer)})
+            if cached_reply is None and full_content.strip():
+                ai_response_cache.set(cache_key, full_content)
 
             if not full_content or not full_content.strip():
-                prev_msg = (
-                    gen_db.query(Message)
-                    .filter(
-                        Message.chat_id == chat_id,
-                        Message.role == "assistant",
-                        Message.workflow_data.isnot(None),
-                    )
-                    .order_by(Message.created_at.desc())
-                    .first()
-                )
-                if prev_msg and prev_msg.workflow_data:
-                    workflow_data = prev_msg.workflow_data
+                if last_workflow_data:
+                    workflow_data = last_workflow_data
                     display_content = "I apologize, I encountered an issue. I've kept your previous workflow intact."
                 else:
-                    yield f"event: error\ndata: {json.dumps({'error': 'Empty AI response'})}\n\n"
+                    yield _sse("error", {"error": "Empty AI response"})
                     return
             else:
-                workflow_data = None
-                display_content = full_content
-                try:
-                    extracted_json, full_match = extract_json_workflow(full_content)
-                    if extracted_json:
-                        workflow_data = extracted_json
-                        parsed = json.loads(workflow_data)
-                        if (
-                            "nodes" not in parsed
-                            or "edges" not in parsed
-                            or len(parsed["nodes"]) == 0
-                        ):
-                            raise ValueError("Invalid workflow structure")
-                        display_content = full_content.replace(full_match, "").strip()
-                        display_content = re.sub(r"```\s*```", "", display_content).strip()
-                        display_content = re.sub(r"\n\s*\n\s*\n+", "\n\n", display_content)
-                        if not display_content or len(display_content) < 10:
-                            display_content = "I've created a workflow visualization for you based on your requirements."
-                    else:
-                        if any(kw in msg_content_lower for kw in WORKFLOW_KEYWORDS):
-                            workflow_data = json.dumps({
-                                "nodes": [
-                                    {"id": "1", "label": "Start", "type": "start"},
-                                    {"id": "2", "label": "Process request", "type": "process"},
-                                    {"id": "3", "label": "Complete", "type": "end"},
-                                ],
-                                "edges": [{"from": "1", "to": "2"}, {"from": "2", "to": "3"}],
-                            })
-                            display_content = (
-                                full_content.strip() if full_content.strip() else "I've created a basic workflow."
-                            )
-                except Exception:
-                    workflow_data = None
-
-            ai_message = Message(
-                chat_id=chat_id,
-                role="assistant",
-                content=display_content,
-                workflow_data=workflow_data,
-            )
-            gen_db.add(ai_message)
-            gen_db.commit()
-            gen_db.refresh(ai_message)
-            if ai_message.workflow_data:
-                ensure_workflow_state(chat_id, ai_message.workflow_data, user_id, gen_db)
-
-            ws_state = (
-                gen_db.query(WorkflowState).filter(WorkflowState.chat_id == chat_id).first()
+                workflow_data, display_content = finalize_workflow(
+                    full_content, msg_content_lower, parser
+                )
+
+            ai_message = await run_in_threadpool(
+                save_ai_message, chat_id, display_content, workflow_data, user_id, gen_db
             )
-            yield (
-                f"event: workflow_complete\n"
-                f"data: {json.dumps({'workflow_data': workflow_data, 'display_content': display_content})}\n\n"
+            workflow_version = await run_in_threadpool(_workflow_version, chat_id, gen_db)
+
+            yield _sse(
+                "workflow_complete",
+                {"workflow_data": workflow_data, "display_content": display_content},
             )
-            yield (
-                f"event: stream_end\n"
-                f"data: {json.dumps({'message_id': ai_message.id, 'workflow_version': ws_state.version if ws_state else None})}\n\n"
+            yield _sse(
+                "stream_end",
+                {
+                    "message_id": ai_message.id,
+                    "workflow_version": workflow_version,
+                },
             )
 
-            await connection_manager.broadcast_to_chat(
+            connection_manager.broadcast_in_background(
                 chat_id,
                 {
                     "type": "new_message",
                     "chat_id": chat_id,
                     "sender_id": user_id,
                     "sender_username": username,
-                    "workflow_version": ws_state.version if ws_state else None,
+                    "workflow_version": workflow_version,
                     "messages": [
                         {
                             "id": user_msg_id,
@@ -357,8 +493,8 @@ async def stream_message(
                             "id": ai_message.id,
                             "chat_id": chat_id,
                             "role": "assistant",
-                            "content": ai_message.content,
-                            "workflow_data": ai_message.workflow_data,
+                            "content": display_content,
+                            "workflow_data": workflow_data,
                             "created_at": ai_message.created_at.isoformat(),
                         },
                     ],
@@ -366,10 +502,12 @@ async def stream_message(
                 exclude_user=user_id,
             )
         except Exception as e:
-            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+            yield _sse("error", {"error": str(e)})
         finally:
-            gen_db.close()
-            await chat_lock_manager.release(chat_id, connection_manager)
+            try:
+                gen_db.close()
+            finally:
+                await chat_lock_manager.release(chat_id, connection_manager)
 
     return StreamingResponse(
         event_generator(),
@@ -396,6 +534,7 @@ async def update_workflow(
     new_data = workflow_data.get("workflow_data")
     msg.workflow_data = new_data
     db.commit()
+    conversation_cache.invalidate(msg.chat_id)
     await connection_manager.broadcast_to_chat(
         msg.chat_id,
         {
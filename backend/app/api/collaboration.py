@@ -3,7 +3,7 @@
 from typing import List
 
 from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import or_
 
 from app.core.database import get_db
@@ -99,11 +99,15 @@ def get_collaborators(
     db: Session = Depends(get_db),
 ):
     get_chat_with_access(chat_id, current_user, db)
-    collabs = db.query(ChatCollaborator).filter(ChatCollaborator.chat_id == chat_id).all()
+    collabs = (
+        db.query(ChatCollaborator)
+        .options(joinedload(ChatCollaborator.user), joinedload(ChatCollaborator.inviter))
+        .filter(ChatCollaborator.chat_id == chat_id)
+        .all()
+    )
     result = []
     for c in collabs:
-        user = db.query(User).filter(User.id == c.user_id).first()
-        inviter = db.query(User).filter(User.id == c.invited_by).first()
+        user, inviter = c.user, c.inviter
         if user:
             result.append(
                 CollaboratorResponse(
@@ -1,11 +1,12 @@
 """WebSocket endpoint."""
 
-from jose import JWTError, jwt
+from jose import JWTError
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
+from sqlalchemy import and_
 
-from app.core.config import settings
 from app.core.database import SessionLocal
+from app.core.security import decode_access_token
 from app.models import User, Chat, ChatCollaborator
 from app.websocket import connection_manager
 
@@ -20,34 +21,37 @@ async def websocket_endpoint(
 ):
     db = SessionLocal()
     try:
-        payload = jwt.decode(
-            token, settings.secret_key, algorithms=[settings.algorithm]
-        )
+        payload = decode_access_token(token)
         username: str = payload.get("sub")
         if not username:
             await websocket.close(code=4001, reason="Invalid token")
             return
 
-        user = db.query(User).filter(User.username == username).first()
-        if not user:
+        # User, chat ownership and collaborator membership in one round trip.
+        row = (
+            db.query(User.id, User.username, Chat.id, Chat.user_id, ChatCollaborator.id)
+            .select_from(User)
+            .outerjoin(Chat, Chat.id == chat_id)
+            .outerjoin(
+                ChatCollaborator,
+                and_(
+                    ChatCollaborator.chat_id == Chat.id,
+                    ChatCollaborator.user_id == User.id,
+                ),
+            )
+            .filter(User.username == username)
+            .first()
+        )
+        if not row:
             await websocket.close(code=4001, reason="User not found")
             return
 
-        chat = db.query(Chat).filter(Chat.id == chat_id).first()
-        if not chat:
+        user_id, username, found_chat_id, owner_id, collab_id = row
+        if found_chat_id is None:
             await websocket.close(code=4004, reason="Chat not found")
             return
 
-        is_owner = chat.user_id == user.id
-        is_collab = (
-            db.query(ChatCollaborator)
-            .filter(
-                ChatCollaborator.chat_id == chat_id,
-                ChatCollaborator.user_id == user.id,
-            )
-            .first()
-        )
-        if not is_owner and not is_collab:
+        if owner_id != user_id and collab_id is None:
             await websocket.close(code=4003, reason="Access denied")
             return
     except JWTError:
@@ -56,7 +60,7 @@ async def websocket_endpoint(
     finally:
         db.close()
 
-    await connection_manager.connect(websocket, chat_id, user.id, user.username)
+    await connection_manager.connect(websocket, chat_id, user_id, username)
 
     try:
         while True:
@@ -69,15 +73,15 @@ async def websocket_endpoint(
                     {
                         "type": "typing",
                         "chat_id": chat_id,
-                        "user_id": user.id,
-                        "username": user.username,
+                        "user_id": user_id,
+                        "username": username,
                         "is_typing": data.get("is_typing", False),
                     },
-                    exclude_user=user.id,
+                    exclude_user=user_id,
                 )
     except WebSocketDisconnect:
-        connection_manager.disconnect(chat_id, user.id)
+        connection_manager.disconnect(chat_id, user_id)
         await connection_manager.broadcast_presence(chat_id)
     except Exception:
-        connection_manager.disconnect(chat_id, user.id)
+        connection_manager.disconnect(chat_id, user_id)
         await connection_manager.broadcast_presence(chat_id)
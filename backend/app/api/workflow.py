@@ -1,9 +1,12 @@
 """Workflow state, operations, versioning, and undo/revert endpoints."""
 
-import json
-from typing import List
+from datetime import datetime
+from typing import List, Optional, Tuple
 
+import orjson
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import literal, null, select, union_all
 from sqlalchemy.orm import Session
 
 from app.core.database import get_db
@@ -19,13 +22,101 @@ from app.schemas import (
     RevertResponse,
 )
 from app.services.chat import get_chat_with_access
-from app.services.workflow import ensure_workflow_state
+from app.services.context_cache import conversation_cache
+from app.services.op_log_cache import op_log_cache
+from app.services.response_cache import ai_response_cache
+from app.services.workflow_state_cache import workflow_state_cache
+from app.services.workflow import build_snapshot, ensure_workflow_state, snapshot_data
 from app.websocket import connection_manager, chat_lock_manager
 from app.utils import Operation, resolve_conflict
 
 router = APIRouter(tags=["workflow"])
 
 
+def _cached_state(chat_id: int, db: Session) -> Optional[dict]:
+    """WorkflowState as a dict, from workflow_state_cache or (on miss) the DB."""
+    state = workflow_state_cache.get(chat_id)
+    if state is not None:
+        return state
+    row = db.query(WorkflowState).filter(WorkflowState.chat_id == chat_id).first()
+    return workflow_state_cache.set_from_row(row) if row else None
+
+
+def _load_state(chat_id: int, user_id: int, db: Session) -> dict:
+    """Like _cached_state, but bootstraps the state from the last AI workflow if missing."""
+    state = workflow_state_cache.get(chat_id)
+    if state is not None:
+        return state
+
+    # One round trip for both the state row and the bootstrap candidate.
+    state_q = select(
+        literal("state").label("src"),
+        WorkflowState.data.label("data"),
+        WorkflowState.version.label("version"),
+        WorkflowState.current_version.label("current_version"),
+        WorkflowState.updated_by.label("updated_by"),
+        WorkflowState.updated_at.label("updated_at"),
+    ).where(WorkflowState.chat_id == chat_id)
+    last_msg_q = (
+        select(
+            literal("msg").label("src"),
+            Message.workflow_data.label("data"),
+            null().label("version"),
+            null().label("current_version"),
+            null().label("updated_by"),
+            null().label("updated_at"),
+        )
+        .where(
+            Message.chat_id == chat_id,
+            Message.role == "assistant",
+            Message.workflow_data.isnot(None),
+        )
+        .order_by(Message.created_at.desc())
+        .limit(1)
+        .subquery()
+    )
+    rows = {
+        row.src: row
+        for row in db.execute(union_all(state_q, select(last_msg_q))).all()
+    }
+
+    if "state" in rows:
+        row = rows["state"]
+        return workflow_state_cache.set(
+            chat_id,
+            {
+                "version": row.version,
+                "current_version": row.current_version,
+                "data": row.data,
+                "updated_by": row.updated_by,
+                "updated_at": row.updated_at,
+            },
+        )
+    if "msg" not in rows:
+        raise HTTPException(status_code=404, detail="No workflow exists for this chat")
+    ensure_workflow_state(chat_id, rows["msg"].data, user_id, db)
+    return workflow_state_cache.get(chat_id)
+
+
+def _sync_last_workflow_message(chat_id: int, data: str, db: Session) -> None:
+    """Point the newest assistant workflow message at `data` with a single UPDATE."""
+    # The derived table lets MySQL update a table it also selects from.
+    last_msg = (
+        select(Message.id)
+        .where(
+            Message.chat_id == chat_id,
+            Message.role == "assistant",
+            Message.workflow_data.isnot(None),
+        )
+        .order_by(Message.created_at.desc())
+        .limit(1)
+        .subquery()
+    )
+    db.query(Message).filter(Message.id == select(last_msg.c.id).scalar_subquery()).update(
+        {Message.workflow_data: data}, synchronize_session=False
+    )
+
+
 @router.get("/chats/{chat_id}/workflow/state", response_model=WorkflowStateResponse)
 def get_workflow_state(
     chat_id: int,
@@ -33,156 +124,203 @@ def get_workflow_state(
     db: Session = Depends(get_db),
 ):
     get_chat_with_access(chat_id, current_user, db)
-    state = db.query(WorkflowState).filter(WorkflowState.chat_id == chat_id).first()
-    if not state:
-        last_workflow_msg = (
-            db.query(Message)
-            .filter(
-                Message.chat_id == chat_id,
-                Message.role == "assistant",
-                Message.workflow_data.isnot(None),
-            )
-            .order_by(Message.created_at.desc())
-            .first()
-        )
-        if not last_workflow_msg:
-            raise HTTPException(status_code=404, detail="No workflow exists for this chat")
-        state = ensure_workflow_state(
-            chat_id, last_workflow_msg.workflow_data, current_user.id, db
-        )
+    state = _load_state(chat_id, current_user.id, db)
     return WorkflowStateResponse(
         chat_id=chat_id,
-        version=state.current_version,
-        max_version=state.version,
-        data=state.data,
-        updated_at=state.updated_at,
-        updated_by=state.updated_by,
+        version=state["current_version"],
+        max_version=state["version"],
+        data=state["data"],
+        updated_at=state["updated_at"],
+        updated_by=state["updated_by"],
     )
 
 
-@router.post("/chats/{chat_id}/workflow/operations", response_model=WorkflowOperationResponse)
-async def apply_workflow_operations(
-    chat_id: int,
-    request: WorkflowOperationRequest,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
-):
+def _apply_operations(
+    chat_id: int, request: WorkflowOperationRequest, current_user: User, db: Session
+) -> Tuple[WorkflowOperationResponse, Optional[dict]]:
+    """Blocking part of apply_workflow_operations; returns (response, broadcast or None)."""
     get_chat_with_access(chat_id, current_user, db)
-    state = db.query(WorkflowState).filter(WorkflowState.chat_id == chat_id).first()
-    if not state:
-        last_workflow_msg = (
-            db.query(Message)
-            .filter(
-                Message.chat_id == chat_id,
-                Message.role == "assistant",
-                Message.workflow_data.isnot(None),
-            )
-            .order_by(Message.created_at.desc())
-            .first()
-        )
-        if not last_workflow_msg:
-            raise HTTPException(status_code=404, detail="No workflow exists for this chat")
-        state = ensure_workflow_state(
-            chat_id, last_workflow_msg.workflow_data, current_user.id, db
-        )
-
     incoming_ops = [Operation(op_type=op.op_type, payload=op.payload) for op in request.operations]
-    op_log = []
-    if request.base_version < state.version:
-        op_records = (
-            db.query(WorkflowOperation)
-            .filter(
-                WorkflowOperation.chat_id == chat_id,
-                WorkflowOperation.version_after > request.base_version,
-                WorkflowOperation.version_after <= state.version,
-                WorkflowOperation.status == "applied",
+
+    # The cached state may be stale; the UPDATE below only matches the exact
+    # version pair we merged against. On a miss we retry once, this time
+    # holding the row lock (SELECT ... FOR UPDATE) so the retry cannot lose.
+    for attempt in range(2):
+        if attempt:
+            db.rollback()
+            workflow_state_cache.invalidate(chat_id)
+            row = (
+                db.query(WorkflowState)
+                .filter(WorkflowState.chat_id == chat_id)
+                .with_for_update()
+                .first()
             )
-            .order_by(WorkflowOperation.version_after.asc())
-            .all()
-        )
-        op_log = [{"op_data": r.op_data} for r in op_records]
-
-    result = resolve_conflict(
-        current_data=state.data,
-        current_version=state.version,
-        base_version=request.base_version,
-        incoming_ops=incoming_ops,
-        op_log=op_log,
-    )
+        else:
+            row = None
+        if row:
+            state = workflow_state_cache.set_from_row(row)
+        else:
+            state = _load_state(chat_id, current_user.id, db)
+
+        op_log = []
+        if request.base_version < state["version"]:
+            op_log = op_log_cache.applied_since(chat_id, request.base_version, state["version"])
+            if op_log is None:
+                op_records = (
+                    db.query(WorkflowOperation.op_data)
+                    .filter(
+                        WorkflowOperation.chat_id == chat_id,
+                        WorkflowOperation.version_after > request.base_version,
+                        WorkflowOperation.version_after <= state["version"],
+                        WorkflowOperation.status == "applied",
+                    )
+                    .order_by(WorkflowOperation.version_after.asc())
+                    .all()
+                )
+                op_log = [{"op_data": op_data} for (op_data,) in op_records]
 
-    if result.status == "conflict":
-        return WorkflowOperationResponse(
-            status="conflict",
-            version=state.current_version,
-            data=state.data,
-            conflicts=result.conflicts,
+        result = resolve_conflict(
+            current_data=state["data"],
+            current_version=state["version"],
+            base_version=request.base_version,
+            incoming_ops=incoming_ops,
+            op_log=op_log,
         )
 
-    db.query(WorkflowSnapshot).filter(
-        WorkflowSnapshot.chat_id == chat_id,
-        WorkflowSnapshot.version > state.current_version,
-    ).delete(synchronize_session=False)
+        if result.status == "conflict":
+            return WorkflowOperationResponse(
+                status="conflict",
+                version=state["current_version"],
+                data=state["data"],
+                conflicts=result.conflicts,
+            ), None
 
-    state.data = result.new_data
-    state.version = result.new_version
-    state.current_version = result.new_version
-    state.updated_by = current_user.id
+        # Idempotent ops (e.g. re-sending a node's current position) change
+        # nothing: skip the version bump, snapshot and broadcast entirely.
+        if result.new_data == state["data"]:
+            return WorkflowOperationResponse(
+                status=result.status,
+                version=state["current_version"],
+                data=state["data"],
+                conflicts=[],
+            ), None
+
+        # Only a reverted pointer leaves a redo tail to truncate.
+        if state["current_version"] < state["version"]:
+            db.query(WorkflowSnapshot).filter(
+                WorkflowSnapshot.chat_id == chat_id,
+                WorkflowSnapshot.version > state["current_version"],
+            ).delete(synchronize_session=False)
+
+        updated_at = datetime.utcnow()
+        updated = (
+            db.query(WorkflowState)
+            .filter(
+                WorkflowState.chat_id == chat_id,
+                WorkflowState.version == state["version"],
+                WorkflowState.current_version == state["current_version"],
+            )
+            .update(
+                {
+                    WorkflowState.data: result.new_data,
+                    WorkflowState.version: result.new_version,
+                    WorkflowState.current_version: result.new_version,
+                    WorkflowState.updated_by: current_user.id,
+                    WorkflowState.updated_at: updated_at,
+                },
+                synchronize_session=False,
+            )
+        )
+        if updated:
+            break
+    else:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Workflow was modified concurrently, please retry")
 
     op_desc = ", ".join(op.op_type for op in incoming_ops)
+    ops_payload = [{"op_type": op.op_type, "payload": op.payload} for op in incoming_ops]
+    op_data = orjson.dumps(ops_payload).decode()
     op_record = WorkflowOperation(
         chat_id=chat_id,
         user_id=current_user.id,
         version_before=request.base_version,
         version_after=result.new_version,
         op_type=op_desc,
-        op_data=json.dumps([{"op_type": op.op_type, "payload": op.payload} for op in incoming_ops]),
+        op_data=op_data,
         status=result.status,
     )
     db.add(op_record)
-    snapshot = WorkflowSnapshot(
-        chat_id=chat_id,
-        version=result.new_version,
-        data=result.new_data,
-        description=f"{current_user.username}: {op_desc}",
-        created_by=current_user.id,
-    )
-    db.add(snapshot)
-
-    last_msg = (
-        db.query(Message)
-        .filter(
-            Message.chat_id == chat_id,
-            Message.role == "assistant",
-            Message.workflow_data.isnot(None),
+    db.add(
+        build_snapshot(
+            chat_id,
+            result.new_version,
+            result.new_data,
+            current_user.id,
+            f"{current_user.username}: {op_desc}",
+            base_version=state["current_version"],
+            base_data=state["data"],
         )
-        .order_by(Message.created_at.desc())
-        .first()
     )
-    if last_msg:
-        last_msg.workflow_data = result.new_data
-    db.commit()
 
-    await connection_manager.broadcast_to_chat(
+    _sync_last_workflow_message(chat_id, result.new_data, db)
+    # Record while the state row is still locked: writers on this chat reach
+    # here one at a time in version order, and no reader can see the new
+    # version committed before its op is in the log (reads stop at the
+    # committed version, so the uncommitted record is never served).
+    op_log_cache.record(chat_id, state["version"], result.new_version, result.status, op_data)
+    try:
+        db.commit()
+    except BaseException:
+        op_log_cache.invalidate(chat_id)
+        raise
+    conversation_cache.invalidate(chat_id)
+    workflow_state_cache.set(
         chat_id,
         {
-            "type": "workflow_op",
-            "chat_id": chat_id,
             "version": result.new_version,
+            "current_version": result.new_version,
             "data": result.new_data,
-            "operations": [{"op_type": op.op_type, "payload": op.payload} for op in incoming_ops],
-            "applied_by": current_user.id,
-            "applied_by_username": current_user.username,
-            "status": result.status,
+            "updated_by": current_user.id,
+            "updated_at": updated_at,
         },
-        exclude_user=current_user.id,
     )
 
+    # Ops only, not the whole workflow: clients behind from_version resync
+    # through GET /workflow/state.
+    broadcast = {
+        "type": "workflow_op",
+        "chat_id": chat_id,
+        "version": result.new_version,
+        "from_version": state["version"],
+        "to_version": result.new_version,
+        "operations": ops_payload,
+        "applied_by": current_user.id,
+        "applied_by_username": current_user.username,
+        "status": result.status,
+    }
     return WorkflowOperationResponse(
         status=result.status,
         version=result.new_version,
         data=result.new_data,
         conflicts=[],
+    ), broadcast
+
+
+@router.post("/chats/{chat_id}/workflow/operations", response_model=WorkflowOperationResponse)
+async def apply_workflow_operations(
+    chat_id: int,
+    request: WorkflowOperationRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    # The DB round trips run in the threadpool so the loop keeps serving
+    # WebSocket traffic; only the broadcast happens on it.
+    response, broadcast = await run_in_threadpool(
+        _apply_operations, chat_id, request, current_user, db
     )
+    if broadcast:
+        await connection_manager.broadcast_to_chat(chat_id, broadcast, exclude_user=current_user.id)
+    return response
 
 
 @router.get("/chats/{chat_id}/workflows/history")
@@ -208,39 +346,54 @@ def get_workflow_history(
     ]
 
 
+def _undo_last_exchange(chat_id: int, db: Session) -> Optional[str]:
+    """Delete the last two messages; returns the workflow that is current afterwards."""
+    # Column-only queries and a bulk DELETE: nothing stale in the identity
+    # map is consulted, so no expire_all() is needed after the lock wait.
+    # (MySQL rejects LIMIT inside an IN subquery, hence the id fetch.)
+    last_ids = [
+        msg_id
+        for (msg_id,) in db.query(Message.id)
+        .filter(Message.chat_id == chat_id)
+        .order_by(Message.created_at.desc())
+        .limit(2)
+    ]
+    if len(last_ids) < 2:
+        raise HTTPException(status_code=400, detail="No messages to undo")
+    db.query(Message).filter(Message.id.in_(last_ids)).delete(synchronize_session=False)
+    prev_workflow_data = (
+        db.query(Message.workflow_data)
+        .filter(
+            Message.chat_id == chat_id,
+            Message.role == "assistant",
+            Message.workflow_data.isnot(None),
+        )
+        .order_by(Message.created_at.desc())
+        .limit(1)
+        .scalar()
+    )
+    db.commit()
+    conversation_cache.invalidate(chat_id)
+    workflow_state_cache.invalidate(chat_id)
+    # Resending the undone message must not replay the reply just undone.
+    ai_response_cache.invalidate(chat_id)
+    return prev_workflow_data
+
+
 @router.post("/chats/{chat_id}/workflows/undo")
 async def undo_workflow(
     chat_id: int,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    get_chat_with_access(chat_id, current_user, db)
+    await run_in_threadpool(get_chat_with_access, chat_id, current_user, db)
     await chat_lock_manager.acquire(
         chat_id, current_user.id, current_user.username, connection_manager
     )
     try:
-        db.expire_all()
-        last_messages = (
-            db.query(Message).filter(Message.chat_id == chat_id).order_by(Message.created_at.desc()).limit(2).all()
-        )
-        if len(last_messages) < 2:
-            raise HTTPException(status_code=400, detail="No messages to undo")
-        for msg in last_messages:
-            db.delete(msg)
-        db.commit()
-        prev_workflow = (
-            db.query(Message)
-            .filter(
-                Message.chat_id == chat_id,
-                Message.role == "assistant",
-                Message.workflow_data.isnot(None),
-            )
-            .order_by(Message.created_at.desc())
-            .first()
-        )
         result = {
             "message": "Undone successfully",
-            "workflow_data": prev_workflow.workflow_data if prev_workflow else None,
+            "workflow_data": await run_in_threadpool(_undo_last_exchange, chat_id, db),
         }
         await connection_manager.broadcast_to_chat(
             chat_id,
@@ -265,86 +418,92 @@ def get_version_timeline(
     db: Session = Depends(get_db),
 ):
     get_chat_with_access(chat_id, current_user, db)
-    state = db.query(WorkflowState).filter(WorkflowState.chat_id == chat_id).first()
-    cur_ver = state.current_version if state else 0
-    snapshots = (
-        db.query(WorkflowSnapshot)
+    state = _cached_state(chat_id, db)
+    cur_ver = state["current_version"] if state else 0
+    # Metadata columns only: the timeline never needs the snapshot blobs.
+    rows = (
+        db.query(
+            WorkflowSnapshot.version,
+            WorkflowSnapshot.description,
+            WorkflowSnapshot.created_by,
+            WorkflowSnapshot.created_at,
+            User.username,
+        )
+        .outerjoin(User, User.id == WorkflowSnapshot.created_by)
         .filter(WorkflowSnapshot.chat_id == chat_id)
         .order_by(WorkflowSnapshot.version.asc())
         .all()
     )
-    entries: List[VersionEntry] = []
-    for snap in snapshots:
-        creator = db.query(User).filter(User.id == snap.created_by).first() if snap.created_by else None
-        entries.append(
-            VersionEntry(
-                version=snap.version,
-                description=snap.description,
-                created_by=snap.created_by,
-                created_by_username=creator.username if creator else None,
-                created_at=snap.created_at,
-                is_current=(snap.version == cur_ver),
-            )
+    entries: List[VersionEntry] = [
+        VersionEntry(
+            version=version,
+            description=description,
+            created_by=created_by,
+            created_by_username=creator_username,
+            created_at=created_at,
+            is_current=(version == cur_ver),
         )
+        for version, description, created_by, created_at, creator_username in rows
+    ]
     return VersionTimelineResponse(chat_id=chat_id, current_version=cur_ver, versions=entries)
 
 
-@router.post("/chats/{chat_id}/workflow/revert", response_model=RevertResponse)
-async def revert_to_version(
-    chat_id: int,
-    request: RevertRequest,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
-):
+def _revert(chat_id: int, target_version: int, current_user: User, db: Session) -> Tuple[str, int]:
+    """Move the version pointer to target_version; returns (data, max_version)."""
     get_chat_with_access(chat_id, current_user, db)
     snapshot = (
         db.query(WorkflowSnapshot)
         .filter(
             WorkflowSnapshot.chat_id == chat_id,
-            WorkflowSnapshot.version == request.target_version,
+            WorkflowSnapshot.version == target_version,
         )
         .first()
     )
     if not snapshot:
-        raise HTTPException(status_code=404, detail=f"Version {request.target_version} not found")
+        raise HTTPException(status_code=404, detail=f"Version {target_version} not found")
     state = db.query(WorkflowState).filter(WorkflowState.chat_id == chat_id).first()
     if not state:
         raise HTTPException(status_code=404, detail="No workflow state found")
 
-    state.current_version = request.target_version
-    state.data = snapshot.data
+    data = snapshot_data(snapshot, db)
+    max_version = state.version
+    state.current_version = target_version
+    state.data = data
     state.updated_by = current_user.id
-    last_msg = (
-        db.query(Message)
-        .filter(
-            Message.chat_id == chat_id,
-            Message.role == "assistant",
-            Message.workflow_data.isnot(None),
-        )
-        .order_by(Message.created_at.desc())
-        .first()
-    )
-    if last_msg:
-        last_msg.workflow_data = snapshot.data
+    _sync_last_workflow_message(chat_id, data, db)
     db.commit()
+    conversation_cache.invalidate(chat_id)
+    workflow_state_cache.invalidate(chat_id)
+    return data, max_version
+
 
+@router.post("/chats/{chat_id}/workflow/revert", response_model=RevertResponse)
+async def revert_to_version(
+    chat_id: int,
+    request: RevertRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    data, max_version = await run_in_threadpool(
+        _revert, chat_id, request.target_version, current_user, db
+    )
     await connection_manager.broadcast_to_chat(
         chat_id,
         {
             "type": "version_revert",
             "chat_id": chat_id,
-            "current_version": state.current_version,
-            "max_version": state.version,
+            "current_version": request.target_version,
+            "max_version": max_version,
             "target_version": request.target_version,
-            "data": snapshot.data,
+            "data": data,
             "reverted_by": current_user.id,
             "reverted_by_username": current_user.username,
         },
         exclude_user=current_user.id,
     )
     return RevertResponse(
-        version=state.current_version,
-        data=snapshot.data,
+        version=request.target_version,
+        data=data,
         message=f"Moved to version {request.target_version}",
     )
 
@@ -370,7 +529,7 @@ def get_version_snapshot(
     creator = db.query(User).filter(User.id == snapshot.created_by).first() if snapshot.created_by else None
     return {
         "version": snapshot.version,
-        "data": snapshot.data,
+        "data": snapshot_data(snapshot, db),
         "description": snapshot.description,
         "created_by_username": creator.username if creator else None,
         "created_at": snapshot.created_at.isoformat(),
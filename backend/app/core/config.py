@@ -13,6 +13,9 @@ class Settings(BaseSettings):
 
     # Database (env: DATABASE_URL)
     database_url: str | None = None
+    db_pool_size: int = 20
+    db_max_overflow: int = 40
+    db_pool_recycle: int = 3600
 
     # Auth
     secret_key: str = "your-secret-key-please-change-in-production"
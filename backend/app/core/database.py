@@ -11,6 +11,15 @@ _db_url = settings.get_database_url()
 _engine_kwargs = {}
 if _db_url.startswith("sqlite"):
     _engine_kwargs["connect_args"] = {"check_same_thread": False}
+else:
+    # MySQL/Postgres: room for concurrent requests, and drop connections the
+    # server has closed while idle (MySQL wait_timeout) instead of failing.
+    _engine_kwargs.update(
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=True,
+    )
 
 engine = create_engine(_db_url, **_engine_kwargs)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -27,6 +36,8 @@ def get_db():
 def init_db() -> None:
     Base.metadata.create_all(bind=engine)
     _migrate_add_current_version()
+    _migrate_add_snapshot_base_version()
+    _migrate_add_indexes()
 
 
 def _migrate_add_current_version() -> None:
@@ -42,3 +53,28 @@ def _migrate_add_current_version() -> None:
             "ALTER TABLE workflow_states ADD COLUMN current_version INTEGER NOT NULL DEFAULT 1"
         ))
         conn.execute(text("UPDATE workflow_states SET current_version = version"))
+
+
+def _migrate_add_snapshot_base_version() -> None:
+    """Add base_version to workflow_snapshots if missing; existing rows stay keyframes."""
+    inspector = inspect(engine)
+    if "workflow_snapshots" not in inspector.get_table_names():
+        return
+    columns = [c["name"] for c in inspector.get_columns("workflow_snapshots")]
+    if "base_version" in columns:
+        return
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE workflow_snapshots ADD COLUMN base_version INTEGER"))
+
+
+def _migrate_add_indexes() -> None:
+    """Create model indexes missing from tables that predate them (create_all skips those)."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
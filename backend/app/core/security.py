@@ -1,11 +1,14 @@
 """Authentication and JWT handling."""
 
+import time
 from datetime import datetime, timedelta
-from typing import Optional
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
+from jose.exceptions import ExpiredSignatureError
 from passlib.context import CryptContext
 from sqlalchemy.orm import Session
 
@@ -39,6 +42,31 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     )
 
 
+@lru_cache(maxsize=2048)
+def _decode_token(token: str, secret_key: str, algorithm: str) -> dict:
+    # Failures raise and are therefore never cached.
+    return jwt.decode(token, secret_key, algorithms=[algorithm])
+
+
+def decode_access_token(token: str) -> dict:
+    """
+    Decoded JWT claims. Tokens are immutable, so signature checks are cached
+    per token; expiry is re-checked on every call. Raises JWTError.
+    """
+    payload = _decode_token(token, settings.secret_key, settings.algorithm)
+    exp = payload.get("exp")
+    if exp is not None and exp < time.time():
+        raise ExpiredSignatureError("Signature has expired.")
+    return payload
+
+
+# token -> (expires_at, detached User). Endpoints only read plain columns off
+# the user, so repeat requests with the same token skip the SELECT.
+USER_CACHE_TTL_SECONDS = 60
+USER_CACHE_MAX_ENTRIES = 2048
+_user_cache: Dict[str, Tuple[float, User]] = {}
+
+
 def get_current_user(
     token: str = Depends(oauth2_scheme),
     db: Session = Depends(get_db),
@@ -49,16 +77,23 @@ def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(
-            token, settings.secret_key, algorithms=[settings.algorithm]
-        )
+        payload = decode_access_token(token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
 
+    cached = _user_cache.get(token)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
     user = db.query(User).filter(User.username == username).first()
     if user is None:
         raise credentials_exception
+    # Detach so the request's commit can't expire it for later requests.
+    db.expunge(user)
+    if len(_user_cache) >= USER_CACHE_MAX_ENTRIES:
+        _user_cache.clear()
+    _user_cache[token] = (time.monotonic() + USER_CACHE_TTL_SECONDS, user)
     return user
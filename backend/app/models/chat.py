@@ -1,5 +1,5 @@
 import enum
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
@@ -21,7 +21,12 @@ class Chat(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     user = relationship("User", back_populates="chats")
-    messages = relationship("Message", back_populates="chat", cascade="all, delete-orphan")
+    messages = relationship(
+        "Message",
+        back_populates="chat",
+        cascade="all, delete-orphan",
+        order_by="Message.created_at",
+    )
     collaborators = relationship(
         "ChatCollaborator", back_populates="chat", cascade="all, delete-orphan"
     )
@@ -40,6 +45,24 @@ class Message(Base):
     chat = relationship("Chat", back_populates="messages")
 
 
+# Chat list per user, newest activity first.
+Index("idx_chats_user_updated", Chat.user_id, Chat.updated_at.desc())
+
+# Ordered message reads per chat (history build, undo's last two, max id).
+Index("idx_msg_chat_created", Message.chat_id, Message.created_at.desc())
+
+# Serves the "last assistant workflow message" lookups (history, undo, bootstrap).
+# Partial where the dialect supports it; MySQL gets the plain composite index.
+_assistant_workflow = (Message.role == "assistant") & Message.workflow_data.isnot(None)
+Index(
+    "idx_msg_assistant_wf",
+    Message.chat_id,
+    Message.created_at.desc(),
+    postgresql_where=_assistant_workflow,
+    sqlite_where=_assistant_workflow,
+)
+
+
 class ChatCollaborator(Base):
     __tablename__ = "chat_collaborators"
     __table_args__ = (UniqueConstraint("chat_id", "user_id", name="uq_chat_collaborator"),)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Index
 from sqlalchemy.orm import relationship, backref
 from datetime import datetime
 
@@ -26,11 +26,15 @@ class WorkflowState(Base):
 
 class WorkflowSnapshot(Base):
     __tablename__ = "workflow_snapshots"
+    __table_args__ = (Index("idx_ws_chat_ver", "chat_id", "version"),)
 
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
     version = Column(Integer, nullable=False)
+    # Keyframes (base_version NULL) hold the full workflow JSON; other rows hold
+    # a JSON Patch against the snapshot at base_version.
     data = Column(Text, nullable=False)
+    base_version = Column(Integer, nullable=True)
     description = Column(String(255), nullable=True)
     created_by = Column(Integer, ForeignKey("users.id"), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -50,3 +54,14 @@ class WorkflowOperation(Base):
     op_data = Column(Text, nullable=False)
     status = Column(String(20), nullable=False, default="applied")
     created_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Partial index for the applied-op log read by apply_workflow_operations.
+_applied = WorkflowOperation.status == "applied"
+Index(
+    "idx_wop_chat_ver",
+    WorkflowOperation.chat_id,
+    WorkflowOperation.version_after,
+    postgresql_where=_applied,
+    sqlite_where=_applied,
+)
@@ -39,6 +39,7 @@ class ChatWithMessages(BaseModel):
     created_at: datetime
     updated_at: datetime
     messages: List[MessageResponse]
+    has_more: bool = False
 
     class Config:
         from_attributes = True
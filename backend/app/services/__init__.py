@@ -1,9 +1,9 @@
-from .ai import build_system_message, build_conversation_history, extract_json_workflow
+from .ai import build_prompt_messages, build_conversation_history, extract_json_workflow
 from .workflow import ensure_workflow_state
 from .chat import get_chat_with_access
 
 __all__ = [
-    "build_system_message",
+    "build_prompt_messages",
     "build_conversation_history",
     "extract_json_workflow",
     "ensure_workflow_state",
@@ -1,90 +1,143 @@
 """OpenAI integration and workflow JSON extraction."""
 
-import json
+import asyncio
 import re
+from functools import lru_cache
 from typing import List, Tuple, Optional
 
+import orjson
+from fastapi.concurrency import run_in_threadpool
+from openai import AsyncOpenAI
 from sqlalchemy.orm import Session
 
+from app.core.config import settings
 from app.models import Message, WorkflowState
+from app.services.context_cache import CachedMessage, conversation_cache
+from app.services.response_cache import ai_response_cache
 from app.services.workflow import ensure_workflow_state
+from app.services.workflow_state_cache import workflow_state_cache
+from app.utils import IncrementalWorkflowParser
+
+_RE_CODE_BLOCK = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+_RE_EMPTY_FENCE = re.compile(r"```(?:json)?\s*```")
+_RE_JSON_STRUCT = re.compile(r'[{}"\\]')
+_RE_TRIPLE_NL = re.compile(r"\n\s*\n\s*\n+")
 
 # System prompt and conversation building are pure functions; no DB here.
 # Callers pass in message lists and last workflow message.
 
 
-def build_system_message(workflow_context: str) -> dict:
-    """Build the system prompt for the OpenAI conversation."""
-    return {
-        "role": "system",
-        "content": f"""You are a helpful assistant that helps companies design and visualize process workflows. You can communicate in English and Spanish.
-
-    When the user requests a workflow:
-    1. Provide a brief explanation of the workflow (1-3 sentences) in the user's language
-    2. ALWAYS include the workflow as valid JSON in this exact format: {{"nodes": [{{"id": "1", "label": "Step name", "type": "start|process|decision|end"}}], "edges": [{{"from": "1", "to": "2"}}]}}
-    3. NEVER return empty responses - always provide both explanation and JSON{workflow_context}
-
-    Guidelines:
-    - For NEW workflows: Create from scratch based on the user's description
-    - For UPDATES/MODIFICATIONS:
-    * CRITICAL: START WITH THE CURRENT WORKFLOW JSON PROVIDED ABOVE
-    * ONLY modify the specific nodes/edges the user explicitly mentioned
-    * Copy all other nodes and edges EXACTLY as they appear in the current workflow
-    * Preserve all node IDs, labels, types, and edge connections that aren't being changed
-    * If updating ONE node label, copy all other nodes with identical IDs and labels
-    * If adding ONE node, copy the entire current workflow and append the new node with the next sequential ID
-    * If removing ONE node:
-      - Remove the node from the nodes array
-      - Remove all edges that connect to/from that node
-      - If removing a DECISION node that creates branches:
-        a) Find all nodes that were AFTER the decision (nodes that the decision pointed to)
-        b) Find what came BEFORE the decision (the parent node)
-        c) Connect the parent node directly to the FIRST branch path (skip the decision)
-        d) Merge the branches back into the main flow at their natural convergence point
-        e) Example: A→Decision→[B,C]→D becomes A→B→D (selecting primary branch)
-      - Ensure no orphaned nodes (nodes with no path from start)
-    * Think of it as copy-paste with minimal edits, not reconstruction
-    - Use sequential IDs starting from "1" for NEW workflows
-    - MUST include exactly one "start" node and at least one "end" node
-    - Use "decision" type for branching points (if/else scenarios)
-    - Ensure all edges connect existing node IDs
-    - Keep labels clear and concise (max 80 characters)
-    - Node labels must be based on user's language: either English or Spanish
-
-    IMPORTANT FOR MODIFICATIONS:
-    - When user says "change/cambiar X", "update/actualizar X", "modify/modificar X" - ONLY change X
-    - The current workflow is your STARTING POINT - copy it and make minimal edits
-    - Do not reorganize, renumber, reorder, or restructure unchanged parts
-    - Imagine you're using find-and-replace, not rewriting from scratch
-    - Preserve the exact structure and IDs from the current workflow
-
-    SPECIAL CASE - Removing Decision Nodes:
-    - When removing a decision node, intelligently merge the branches (parent → primary branch; remove alternate branches if they don't rejoin).
-
-    CRITICAL: EVERY workflow request MUST include valid JSON with at least:
-    - One "start" node, one "end" node, at least one connecting edge, proper node IDs (no duplicates).
-
-    Spanish keywords: flujo, diagrama, proceso, flujo de trabajo, flowchart
-    English keywords: workflow, flowchart, process, flow
-
-    ALWAYS provide both explanation AND valid JSON. Never provide responses without JSON when a workflow is requested.""",
-    }
-
-
-def build_conversation_history(messages, last_workflow_msg) -> Tuple[List[dict], str]:
-    """Build conversation array and workflow context string from message history."""
+# httpx applies the timeout per read, so streams get it between chunks.
+OPENAI_TIMEOUT_SECONDS = 25.0
+OPENAI_MAX_RETRIES = 1
+# A non-streamed reply arrives in one read, so it is bounded instead by one
+# deadline shared by every attempt (SDK retry and empty-reply retry included).
+OPENAI_REPLY_DEADLINE_SECONDS = 90.0
+
+
+@lru_cache
+def get_openai_client() -> AsyncOpenAI:
+    """Shared async OpenAI client (one connection pool for the whole process)."""
+    return AsyncOpenAI(
+        api_key=settings.openai_api_key,
+        timeout=OPENAI_TIMEOUT_SECONDS,
+        max_retries=OPENAI_MAX_RETRIES,
+    )
+
+
+# Byte-identical on every call so OpenAI's automatic prompt caching can reuse
+# the prefix; the per-chat workflow goes in a trailing message instead.
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": """You are a helpful assistant that helps companies design and visualize process workflows. You can communicate in English and Spanish.
+
+When the user requests a workflow, ALWAYS reply with both:
+1. A brief explanation (1-3 sentences) in the user's language
+2. The workflow as valid JSON in this exact format: {"nodes": [{"id": "1", "label": "Step name", "type": "start|process|decision|end"}], "edges": [{"from": "1", "to": "2"}]}
+
+Rules for every workflow:
+- Exactly one "start" node, at least one "end" node, "decision" nodes for branching (if/else)
+- Unique node IDs; every edge connects existing IDs; no orphaned nodes (each reachable from start)
+- New workflows use sequential IDs starting from "1"
+- Labels are concise (max 80 characters) and in the user's language (English or Spanish)
+
+Modifying the current workflow (change/cambiar, update/actualizar, modify/modificar X):
+- Copy the current workflow and edit ONLY what the user asked for, like find-and-replace
+- Keep every other node and edge exactly as is: same IDs, labels, types, order; never renumber or restructure
+- Adding a node: append it with the next sequential ID
+- Removing a node: drop it and every edge to/from it. For a decision node, connect its parent directly to the primary branch and merge branches at their convergence point (A→Decision→[B,C]→D becomes A→B→D)""",
+}
+
+
+# Non-streamed replies use JSON mode so the workflow is read with one json.loads;
+# the stream keeps prose + JSON because its text is shown as it arrives.
+STRUCTURED_REPLY_MESSAGE = {
+    "role": "system",
+    "content": (
+        'Reply with a single JSON object: {"explanation": "<the brief explanation>", '
+        '"workflow": <the workflow object, or null if no workflow is needed>}'
+    ),
+}
+
+
+def build_prompt_messages(
+    conversation: List[dict], workflow_context: str, structured: bool = False
+) -> List[dict]:
+    """Full message list for OpenAI: static system prompt, history, then the current workflow."""
+    messages = [SYSTEM_MESSAGE, *conversation]
+    if workflow_context:
+        messages.append({"role": "system", "content": workflow_context})
+    if structured:
+        messages.append(STRUCTURED_REPLY_MESSAGE)
+    return messages
+
+
+# Rough history budget; ~4 characters per token is close enough for English/Spanish.
+HISTORY_TOKEN_BUDGET = 6000
+HISTORY_MAX_MESSAGES = 6
+_CHARS_PER_TOKEN = 4
+
+
+def build_conversation_history(
+    messages,
+    last_workflow_msg,
+    max_tokens: int = HISTORY_TOKEN_BUDGET,
+    max_messages: int = HISTORY_MAX_MESSAGES,
+    total: Optional[int] = None,
+) -> Tuple[List[dict], str]:
+    """
+    Build conversation array and workflow context string from message history.
+
+    The most recent turns (at most `max_messages`) are kept verbatim up to
+    `max_tokens`; anything older collapses into one stub line. Assistant turns
+    carry only their text: the latest workflow reaches the model once through
+    the workflow context, so nothing needed for edits is lost. `messages` may
+    be just the tail of the chat if `total` gives the full message count.
+    """
+    recent: List[dict] = []
+    budget = max_tokens * _CHARS_PER_TOKEN
+    for msg in reversed(messages[-max_messages:]):
+        # Only the latest workflow is sent, once, via workflow_context.
+        content = msg.content
+        budget -= len(content)
+        if budget < 0 and recent:
+            break
+        recent.append({"role": msg.role, "content": content})
+    recent.reverse()
+
     conversation = []
-    for msg in messages:
-        if msg.role == "assistant" and msg.workflow_data:
-            content = f"{msg.content}\n\nCurrent workflow JSON:\n{msg.workflow_data}"
-            conversation.append({"role": msg.role, "content": content})
-        else:
-            conversation.append({"role": msg.role, "content": msg.content})
+    omitted = (len(messages) if total is None else total) - len(recent)
+    if omitted:
+        conversation.append({
+            "role": "system",
+            "content": f"[{omitted} earlier messages omitted; the current workflow is provided below.]",
+        })
+    conversation.extend(recent)
 
     workflow_context = ""
     if last_workflow_msg and last_workflow_msg.workflow_data:
         workflow_context = (
-            f"\n\nCURRENT WORKFLOW (use this as your baseline for any modifications):\n"
+            f"CURRENT WORKFLOW (use this as your baseline for any modifications):\n"
             f"{last_workflow_msg.workflow_data}\n\n"
             "When making changes, start with this exact workflow and ONLY modify what the user specifically requests."
         )
@@ -92,39 +145,118 @@ def build_conversation_history(messages, last_workflow_msg) -> Tuple[List[dict],
     return conversation, workflow_context
 
 
+def load_conversation_context(chat_id: int, db: Session) -> Tuple[List[dict], str, Optional[str]]:
+    """
+    Return (conversation, workflow_context, last_workflow_data) for the chat.
+    With a cached tail only messages newer than it are loaded; otherwise the
+    whole chat is read once and the tail cached for the next request.
+    """
+    # Read before the query: an invalidate from here on voids this build.
+    generation = conversation_cache.generation(chat_id)
+    cached = conversation_cache.get(chat_id)
+    query = db.query(Message).filter(Message.chat_id == chat_id)
+    if cached is None:
+        last_message_id, total, tail, last_workflow_msg = 0, 0, [], None
+    else:
+        last_message_id, total, tail, last_workflow_msg = cached
+        query = query.filter(Message.id > last_message_id)
+    messages = query.order_by(Message.id).all()
+
+    if messages:
+        last_message_id = messages[-1].id
+        total += len(messages)
+        tail = tail + [
+            CachedMessage(m.role, m.content) for m in messages[-HISTORY_MAX_MESSAGES:]
+        ]
+        del tail[:-HISTORY_MAX_MESSAGES]
+        # The latest workflow is in the loaded rows or already cached; no second query.
+        newest_workflow = next(
+            (m for m in reversed(messages) if m.role == "assistant" and m.workflow_data), None
+        )
+        if newest_workflow is not None:
+            last_workflow_msg = CachedMessage(
+                newest_workflow.role, newest_workflow.content, newest_workflow.workflow_data
+            )
+        conversation_cache.set(chat_id, generation, last_message_id, total, tail, last_workflow_msg)
+
+    conversation, workflow_context = build_conversation_history(
+        tail, last_workflow_msg, total=total
+    )
+    last_workflow_data = last_workflow_msg.workflow_data if last_workflow_msg else None
+    return conversation, workflow_context, last_workflow_data
+
+
+def _balanced_objects(text: str) -> List[str]:
+    """
+    Top-level {...} spans of text in one linear pass, skipping braces inside
+    JSON string literals. Replaces a 3-level nested regex that backtracked
+    badly on long replies.
+    """
+    spans: List[str] = []
+    depth = 0
+    start = 0
+    in_string = False
+    escaped_at = -1
+    for match in _RE_JSON_STRUCT.finditer(text):
+        i = match.start()
+        if i == escaped_at:
+            continue
+        ch = text[i]
+        if in_string:
+            if ch == "\\":
+                escaped_at = i + 1
+            elif ch == '"':
+                in_string = False
+        elif ch == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == "}":
+            if depth:
+                depth -= 1
+                if depth == 0:
+                    spans.append(text[start:i + 1])
+        elif ch == '"' and depth:
+            in_string = True
+    return spans
+
+
 def extract_json_workflow(text: str) -> Tuple[Optional[str], Optional[str]]:
     """
     Try multiple methods to extract a workflow JSON object from AI response text.
     Returns (json_string, full_match_string) or (None, None).
     """
-    code_block_match = re.search(r"```(?:json)?\s*(\{.*?\})\s*```", text, re.DOTALL)
+    code_block_match = _RE_CODE_BLOCK.search(text)
     if code_block_match:
         try:
-            data = json.loads(code_block_match.group(1))
+            data = orjson.loads(code_block_match.group(1))
             if "nodes" in data and "edges" in data:
                 return code_block_match.group(1), code_block_match.group(0)
-        except (json.JSONDecodeError, ValueError):
+        except ValueError:
             pass
 
-    json_pattern = r"\{(?:[^{}]|(?:\{(?:[^{}]|(?:\{[^{}]*\}))*\}))*\}"
-    json_matches = list(re.finditer(json_pattern, text, re.DOTALL))
-    json_matches.sort(key=lambda m: len(m.group(0)), reverse=True)
-
-    for match in json_matches:
+    for candidate in sorted(_balanced_objects(text), key=len, reverse=True):
         try:
-            data = json.loads(match.group(0))
+            data = orjson.loads(candidate)
             if "nodes" in data and "edges" in data:
                 if isinstance(data["nodes"], list) and isinstance(data["edges"], list):
                     if len(data["nodes"]) > 0:
-                        return match.group(0), match.group(0)
-        except (json.JSONDecodeError, ValueError):
+                        return candidate, candidate
+        except ValueError:
             continue
 
     return None, None
 
 
+def strip_workflow_json(text: str, full_match: str) -> str:
+    """Remove the extracted workflow JSON (and leftover empty fences) from the reply text."""
+    display_content = text.replace(full_match, "").strip()
+    display_content = _RE_EMPTY_FENCE.sub("", display_content).strip()
+    return _RE_TRIPLE_NL.sub("\n\n", display_content)
+
+
 # Fallback workflow when parsing fails or API errors
-FALLBACK_WORKFLOW = json.dumps({
+FALLBACK_WORKFLOW = orjson.dumps({
     "nodes": [
         {"id": "1", "label": "Start", "type": "start"},
         {"id": "2", "label": "Process Request", "type": "process"},
@@ -136,12 +268,150 @@ FALLBACK_WORKFLOW = json.dumps({
         {"from": "2", "to": "3"},
         {"from": "3", "to": "4"},
     ],
+}).decode()
+
+# Minimal workflow used when a workflow was requested but the reply had no JSON
+BASIC_WORKFLOW = orjson.dumps({
+    "nodes": [
+        {"id": "1", "label": "Start", "type": "start"},
+        {"id": "2", "label": "Process request", "type": "process"},
+        {"id": "3", "label": "Complete", "type": "end"},
+    ],
+    "edges": [{"from": "1", "to": "2"}, {"from": "2", "to": "3"}],
+}).decode()
+
+# Whole-word matches; plurals listed so "processes"/"flujos" still count
+WORKFLOW_KEYWORDS = frozenset({
+    "workflow", "workflows", "flowchart", "flowcharts", "process", "processes",
+    "flujo", "flujos", "diagrama", "diagramas", "flujograma", "flujogramas",
 })
+_RE_WORD = re.compile(r"[a-záéíóúñü]+")
+
 
-WORKFLOW_KEYWORDS = ["workflow", "flowchart", "process", "flujo", "diagrama"]
+def mentions_workflow(content_lower: str) -> bool:
+    """True if the (already lowercased) user message names a workflow keyword."""
+    return not WORKFLOW_KEYWORDS.isdisjoint(_RE_WORD.findall(content_lower))
+
+
+# Output tokens dominate latency, so the completion cap follows what the reply
+# needs: prose plus, for edits, a copy of the current workflow.
+DEFAULT_COMPLETION_TOKENS = 800
+MAX_COMPLETION_TOKENS = 5000
+DETAILED_KEYWORDS = frozenset({
+    "complex", "detailed", "comprehensive", "complete", "full",
+    "complejo", "compleja", "detallado", "detallada", "completo", "completa",
+})
 
 
-def generate_ai_response(
+def completion_token_limit(content_lower: str, workflow_context: str) -> int:
+    """max_completion_tokens for a reply to this (lowercased) user message."""
+    if not DETAILED_KEYWORDS.isdisjoint(_RE_WORD.findall(content_lower)):
+        return MAX_COMPLETION_TOKENS
+    return min(
+        MAX_COMPLETION_TOKENS,
+        DEFAULT_COMPLETION_TOKENS + len(workflow_context) // _CHARS_PER_TOKEN,
+    )
+
+
+WORKFLOW_CREATED_MESSAGE = "I've created a workflow visualization for you based on your requirements. You can see it in the visualization panel on the right."
+BASIC_WORKFLOW_MESSAGE = "I've created a basic workflow structure for you."
+
+
+def finalize_workflow(
+    content: str,
+    message_lower: str,
+    parser: Optional[IncrementalWorkflowParser] = None,
+) -> Tuple[Optional[str], str]:
+    """
+    Split a finished AI reply into (workflow_data, display_content).
+
+    Uses the stream parser's already-validated workflow when it has one and
+    only falls back to regex extraction otherwise. If no workflow JSON is
+    found but the user asked for one, the basic workflow is used.
+    """
+    workflow_data = None
+    display_content = content
+    try:
+        extracted_json = parser.finalize() if parser else None
+        full_match = extracted_json
+        if not extracted_json:
+            extracted_json, full_match = extract_json_workflow(content)
+            if extracted_json:
+                parsed = orjson.loads(extracted_json)
+                if "nodes" not in parsed or "edges" not in parsed or len(parsed["nodes"]) == 0:
+                    raise ValueError("Invalid workflow structure")
+        if extracted_json:
+            workflow_data = extracted_json
+            display_content = strip_workflow_json(content, full_match)
+            if not display_content or len(display_content) < 10:
+                display_content = WORKFLOW_CREATED_MESSAGE
+        elif mentions_workflow(message_lower):
+            workflow_data = BASIC_WORKFLOW
+            display_content = content.strip() or BASIC_WORKFLOW_MESSAGE
+    except Exception:
+        workflow_data = None
+    return workflow_data, display_content
+
+
+def parse_structured_reply(content: str, message_lower: str) -> Tuple[Optional[str], str]:
+    """
+    Split a JSON-mode reply ({"explanation", "workflow"}) into
+    (workflow_data, display_content). Anything that isn't that object goes
+    through finalize_workflow like a prose reply.
+    """
+    try:
+        parsed = orjson.loads(content)
+    except ValueError:
+        parsed = None
+    if not isinstance(parsed, dict):
+        return finalize_workflow(content, message_lower)
+
+    explanation = parsed.get("explanation")
+    display_content = explanation.strip() if isinstance(explanation, str) else ""
+    workflow = parsed.get("workflow")
+    if (
+        isinstance(workflow, dict)
+        and isinstance(workflow.get("nodes"), list)
+        and isinstance(workflow.get("edges"), list)
+        and workflow["nodes"]
+    ):
+        if len(display_content) < 10:
+            display_content = WORKFLOW_CREATED_MESSAGE
+        return orjson.dumps(workflow).decode(), display_content
+    if mentions_workflow(message_lower):
+        return BASIC_WORKFLOW, display_content or BASIC_WORKFLOW_MESSAGE
+    return None, display_content or content
+
+
+async def _complete(
+    messages: List[dict], max_tokens: int, deadline: float, **options
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    One non-streamed JSON-mode completion, cut off at `deadline` (event loop
+    time). Returns (content, finish_reason).
+    """
+    remaining = deadline - asyncio.get_running_loop().time()
+    if remaining <= 0:
+        raise TimeoutError("OpenAI reply deadline exceeded")
+    client = get_openai_client().with_options(timeout=remaining)
+    try:
+        response = await asyncio.wait_for(
+            client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                max_completion_tokens=max_tokens,
+                response_format={"type": "json_object"},
+                **options,
+            ),
+            remaining,
+        )
+    except asyncio.TimeoutError:
+        raise TimeoutError("OpenAI reply deadline exceeded") from None
+    choice = response.choices[0]
+    return choice.message.content, choice.finish_reason
+
+
+async def generate_ai_response(
     chat_id: int,
     message_content: str,
     user_message: Message,
@@ -153,115 +423,99 @@ def generate_ai_response(
     Call OpenAI, parse workflow JSON, persist assistant message and workflow state.
     Returns the created assistant Message. On API/parse errors, returns a fallback message.
     """
-    from openai import OpenAI
-
-    from app.core.config import settings
+    conversation, workflow_context, last_workflow_data = await run_in_threadpool(
+        load_conversation_context, chat_id, db
+    )
+    # Hand the connection back to the pool while waiting on OpenAI; the
+    # session starts a fresh transaction for the save afterwards.
+    db.close()
+
+    messages = build_prompt_messages(conversation, workflow_context, structured=True)
+    cache_key = ai_response_cache.key(chat_id, messages)
+    ai_content = ai_response_cache.get(cache_key)
+    if ai_content is None:
+        max_tokens = completion_token_limit(message_content.lower(), workflow_context)
+        deadline = asyncio.get_running_loop().time() + OPENAI_REPLY_DEADLINE_SECONDS
+        try:
+            ai_content, finish_reason = await _complete(messages, max_tokens, deadline)
+            if not ai_content or not ai_content.strip():
+                # Empty replies are usually transient: retry once, deterministic
+                # and shorter, before keeping the previous workflow.
+                max_tokens //= 2
+                ai_content, finish_reason = await _complete(
+                    messages, max_tokens, deadline, temperature=0
+                )
+            if finish_reason == "length" and max_tokens < MAX_COMPLETION_TOKENS:
+                # JSON cut off at the token cap can't be parsed: retry once
+                # with the full cap.
+                ai_content, finish_reason = await _complete(messages, MAX_COMPLETION_TOKENS, deadline)
+        except Exception as e:
+            return await run_in_threadpool(_create_fallback_message, chat_id, db, user_id, str(e))
+        if finish_reason == "length":
+            # Still truncated: keep the previous workflow rather than saving
+            # half a JSON object as the reply.
+            ai_content = None
+        elif finish_reason == "stop" and ai_content and ai_content.strip():
+            ai_response_cache.set(cache_key, ai_content)
 
-    client = OpenAI(api_key=settings.openai_api_key, timeout=120.0)
+    if not ai_content or not ai_content.strip():
+        return await run_in_threadpool(_save_empty_reply, chat_id, last_workflow_data, user_id, db)
 
-    messages = db.query(Message).filter(Message.chat_id == chat_id).order_by(Message.created_at).all()
-    last_workflow_msg = (
-        db.query(Message)
-        .filter(
-            Message.chat_id == chat_id,
-            Message.role == "assistant",
-            Message.workflow_data.isnot(None),
-        )
-        .order_by(Message.created_at.desc())
-        .first()
-    )
+    workflow_data, display_content = parse_structured_reply(ai_content, message_content.lower())
 
-    conversation, workflow_context = build_conversation_history(messages, last_workflow_msg)
-    system_message = build_system_message(workflow_context)
+    return await run_in_threadpool(save_ai_message, chat_id, display_content, workflow_data, user_id, db)
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[system_message] + conversation,
-            max_completion_tokens=5000,
-        )
-        ai_content = response.choices[0].message.content
-    except Exception as e:
-        return _create_fallback_message(chat_id, db, user_id, str(e))
 
-    if not ai_content or not ai_content.strip():
-        prev = (
-            db.query(Message)
-            .filter(
-                Message.chat_id == chat_id,
-                Message.role == "assistant",
-                Message.workflow_data.isnot(None),
-            )
-            .order_by(Message.created_at.desc())
-            .first()
+def _save_empty_reply(
+    chat_id: int, last_workflow_data: Optional[str], user_id: int, db: Session
+) -> Message:
+    """Keep the previous workflow when the model returned nothing."""
+    if last_workflow_data:
+        return save_ai_message(
+            chat_id,
+            "I apologize, I encountered an issue generating a response. I've kept your previous workflow intact. Please try rephrasing your request or ask me to create a new workflow.",
+            last_workflow_data,
+            user_id,
+            db,
         )
-        if prev and prev.workflow_data:
-            ai_message = Message(
-                chat_id=chat_id,
-                role="assistant",
-                content="I apologize, I encountered an issue generating a response. I've kept your previous workflow intact. Please try rephrasing your request or ask me to create a new workflow.",
-                workflow_data=prev.workflow_data,
-            )
-            db.add(ai_message)
-            db.commit()
-            db.refresh(ai_message)
-            if ai_message.workflow_data:
-                ensure_workflow_state(chat_id, ai_message.workflow_data, user_id, db)
-            return ai_message
-        return _create_fallback_message(chat_id, db, user_id, "Empty AI response")
-
-    workflow_data = None
-    display_content = ai_content
+    return _create_fallback_message(chat_id, db, user_id, "Empty AI response")
 
-    try:
-        extracted_json, full_match = extract_json_workflow(ai_content)
-        if extracted_json:
-            workflow_data = extracted_json
-            parsed = json.loads(workflow_data)
-            if "nodes" not in parsed or "edges" not in parsed or len(parsed["nodes"]) == 0:
-                raise ValueError("Invalid workflow structure")
-            display_content = ai_content.replace(full_match, "").strip()
-            display_content = re.sub(r"```\s*```", "", display_content).strip()
-            display_content = re.sub(r"\n\s*\n\s*\n+", "\n\n", display_content)
-            if not display_content or len(display_content) < 10:
-                display_content = "I've created a workflow visualization for you based on your requirements. You can see it in the visualization panel on the right."
-        else:
-            if any(kw in message_content.lower() for kw in WORKFLOW_KEYWORDS):
-                workflow_data = json.dumps({
-                    "nodes": [
-                        {"id": "1", "label": "Start", "type": "start"},
-                        {"id": "2", "label": "Process request", "type": "process"},
-                        {"id": "3", "label": "Complete", "type": "end"},
-                    ],
-                    "edges": [{"from": "1", "to": "2"}, {"from": "2", "to": "3"}],
-                })
-                display_content = ai_content or "I've created a basic workflow structure for you."
-    except Exception:
-        workflow_data = None
 
+def save_ai_message(
+    chat_id: int,
+    content: str,
+    workflow_data: Optional[str],
+    user_id: int,
+    db: Session,
+) -> Message:
+    """Insert the assistant message and bump the workflow state in one transaction."""
     ai_message = Message(
         chat_id=chat_id,
         role="assistant",
-        content=display_content,
+        content=content,
         workflow_data=workflow_data,
     )
     db.add(ai_message)
+    # The flush assigns id; created_at comes from the Python-side default.
+    db.flush()
+    fresh_state = None
+    if workflow_data:
+        state = ensure_workflow_state(chat_id, workflow_data, user_id, db, commit=False)
+        fresh_state = workflow_state_cache.row_values(state)
+    # Detach before commit so the loaded attributes aren't expired and
+    # re-SELECTed (content/workflow_data can be large) on next access.
+    db.expunge(ai_message)
     db.commit()
-    db.refresh(ai_message)
-    if ai_message.workflow_data:
-        ensure_workflow_state(chat_id, ai_message.workflow_data, user_id, db)
+    if fresh_state:
+        workflow_state_cache.set(chat_id, fresh_state)
     return ai_message
 
 
 def _create_fallback_message(chat_id: int, db: Session, user_id: int, error_detail: str) -> Message:
-    ai_message = Message(
-        chat_id=chat_id,
-        role="assistant",
-        content=f"I can help you design a workflow. Here's a sample process visualization. (Note: OpenAI API is not configured - {error_detail})",
-        workflow_data=FALLBACK_WORKFLOW,
+    return save_ai_message(
+        chat_id,
+        f"I can help you design a workflow. Here's a sample process visualization. (Note: OpenAI API is not configured - {error_detail})",
+        FALLBACK_WORKFLOW,
+        user_id,
+        db,
     )
-    db.add(ai_message)
-    db.commit()
-    db.refresh(ai_message)
-    ensure_workflow_state(chat_id, ai_message.workflow_data, user_id, db)
-    return ai_message
@@ -1,6 +1,7 @@
 """Chat access control and helpers."""
 
 from fastapi import HTTPException
+from sqlalchemy import and_
 from sqlalchemy.orm import Session
 
 from app.models import Chat, ChatCollaborator, User
@@ -17,26 +18,35 @@ def get_chat_with_access(
     If require_role is set, collaborators must have that role (e.g. 'editor').
     Raises 404 if chat doesn't exist or user has no access.
     """
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
-    if not chat:
+    # Sessions are per request (get_db), so db.info memoizes the lookup for
+    # the rest of the request.
+    cache = db.info.setdefault("chat_access", {})
+    key = (chat_id, user.id)
+    if key not in cache:
+        cache[key] = (
+            db.query(Chat, ChatCollaborator.role)
+            .outerjoin(
+                ChatCollaborator,
+                and_(
+                    ChatCollaborator.chat_id == Chat.id,
+                    ChatCollaborator.user_id == user.id,
+                ),
+            )
+            .filter(Chat.id == chat_id)
+            .first()
+        )
+    row = cache[key]
+    if not row:
         raise HTTPException(status_code=404, detail="Chat not found")
 
+    chat, collab_role = row
     if chat.user_id == user.id:
         return chat
 
-    collab = (
-        db.query(ChatCollaborator)
-        .filter(
-            ChatCollaborator.chat_id == chat_id,
-            ChatCollaborator.user_id == user.id,
-        )
-        .first()
-    )
-
-    if not collab:
+    if collab_role is None:
         raise HTTPException(status_code=404, detail="Chat not found")
 
-    if require_role and collab.role != require_role:
+    if require_role and collab_role != require_role:
         raise HTTPException(
             status_code=403,
             detail=f"You need '{require_role}' access to perform this action",
@@ -0,0 +1,79 @@
+"""In-process cache of the per-chat message tail used to build the OpenAI context."""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class CachedMessage:
+    role: str
+    content: str
+    workflow_data: Optional[str] = None
+
+
+class ConversationContextCache:
+    """
+    Keeps, per chat, what the history builder needs: the newest message id
+    seen, the total message count, the last few messages and the latest
+    workflow message. A request that finds an entry only loads messages
+    newer than that id (usually just the user turn it has committed) and
+    extends the entry; edits to existing messages must call `invalidate`.
+
+    Entries are built in threadpool threads without the chat lock, so a
+    workflow op or revert can commit and invalidate mid-build. Each
+    invalidate bumps the chat's generation; a builder reads it before its
+    query and `set` drops the result if it has moved on.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: int = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # chat_id -> (last_message_id, stored_at, total, tail, last_workflow_msg)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._generations: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def generation(self, chat_id: int) -> int:
+        return self._generations.get(chat_id, 0)
+
+    def get(
+        self, chat_id: int
+    ) -> Optional[Tuple[int, int, List[CachedMessage], Optional[CachedMessage]]]:
+        """(last_message_id, total, tail, last_workflow_msg) for the chat, or None."""
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return None
+        last_message_id, stored_at, total, tail, last_workflow_msg = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            self._entries.pop(chat_id, None)
+            return None
+        self._entries.move_to_end(chat_id)
+        return last_message_id, total, tail, last_workflow_msg
+
+    def set(
+        self,
+        chat_id: int,
+        generation: int,
+        last_message_id: int,
+        total: int,
+        tail: List[CachedMessage],
+        last_workflow_msg: Optional[CachedMessage] = None,
+    ) -> None:
+        with self._lock:
+            if self._generations.get(chat_id, 0) != generation:
+                return
+            self._entries[chat_id] = (last_message_id, time.monotonic(), total, tail, last_workflow_msg)
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id: int) -> None:
+        with self._lock:
+            self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+            self._entries.pop(chat_id, None)
+
+
+conversation_cache = ConversationContextCache()
@@ -0,0 +1,68 @@
+"""In-process window of recent WorkflowOperation records, keyed by chat_id."""
+
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
+
+
+class OpLogCache:
+    """
+    Keeps the last `max_ops` operation records per chat, in version order.
+    Each chat's window also remembers the version from which it has seen
+    every operation (`covered_from`); a stale client whose base_version is
+    at or above it can be caught up from memory, anything older goes to the DB.
+
+    Writers record from threadpool threads while still holding the state
+    row lock, so records normally arrive in version order; the lock and the
+    ordered insert keep the window sorted (and `covered_from` right) even
+    if they don't. A record whose transaction then fails must be dropped
+    with invalidate().
+    """
+
+    def __init__(self, max_chats: int = 512, max_ops: int = 256):
+        self.max_chats = max_chats
+        self.max_ops = max_ops
+        # chat_id -> [covered_from, deque of (version_after, status, op_data)]
+        self._chats: "OrderedDict[int, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(
+        self, chat_id: int, prev_version: int, version_after: int, status: str, op_data: str
+    ) -> None:
+        with self._lock:
+            entry = self._chats.get(chat_id)
+            if entry is None:
+                entry = [prev_version, deque(maxlen=self.max_ops)]
+                self._chats[chat_id] = entry
+            ops: Deque[Tuple[int, str, str]] = entry[1]
+            if len(ops) == ops.maxlen:
+                evicted_version = ops.popleft()[0]
+                entry[0] = max(entry[0], evicted_version)
+            if version_after > entry[0]:
+                index = len(ops)
+                while index and ops[index - 1][0] > version_after:
+                    index -= 1
+                ops.insert(index, (version_after, status, op_data))
+            self._chats.move_to_end(chat_id)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+
+    def applied_since(self, chat_id: int, base_version: int, head_version: int) -> Optional[List[dict]]:
+        """Applied ops with base_version < version_after <= head_version, or None on a miss."""
+        with self._lock:
+            entry = self._chats.get(chat_id)
+            if entry is None or base_version < entry[0]:
+                return None
+            self._chats.move_to_end(chat_id)
+            return [
+                {"op_data": op_data}
+                for version_after, status, op_data in entry[1]
+                if base_version < version_after <= head_version and status == "applied"
+            ]
+
+    def invalidate(self, chat_id: int) -> None:
+        with self._lock:
+            self._chats.pop(chat_id, None)
+
+
+op_log_cache = OpLogCache()
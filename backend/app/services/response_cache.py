@@ -0,0 +1,59 @@
+"""In-process TTL cache of raw AI replies, keyed by chat and the exact prompt sent."""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import orjson
+
+
+class AIResponseCache:
+    """
+    Remembers the model's raw reply so a retried request skips the OpenAI
+    call. The key hashes the full prompt message list: system prompt,
+    recent conversation and current workflow. A short follow-up like "yes"
+    only hits when the turns before it are the same too, and editing the
+    system prompt retires old replies. Chat delete and undo invalidate from
+    threadpool threads, so every access takes the lock.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: int = 600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(chat_id: int, prompt_messages: List[dict]) -> Tuple[int, str]:
+        # The chat id stays outside the digest so invalidate() can find its entries.
+        digest = hashlib.blake2b(orjson.dumps(prompt_messages), digest_size=16)
+        return chat_id, digest.hexdigest()
+
+    def get(self, key: Tuple[int, str]) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, reply = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return reply
+
+    def set(self, key: Tuple[int, str], reply: str) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id: int) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == chat_id]:
+                del self._entries[key]
+
+
+ai_response_cache = AIResponseCache()
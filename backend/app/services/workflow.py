@@ -1,8 +1,91 @@
 """Workflow state and version/snapshot management."""
 
+from datetime import datetime
+from typing import Optional
+
+import jsonpatch
+import orjson
+from sqlalchemy import func, select
 from sqlalchemy.orm import Session
 
 from app.models import WorkflowState, WorkflowSnapshot, Message
+from app.services.workflow_state_cache import workflow_state_cache
+
+# Every Nth version is stored in full; the ones in between are JSON Patches.
+SNAPSHOT_KEYFRAME_INTERVAL = 10
+
+
+def build_snapshot(
+    chat_id: int,
+    version: int,
+    data: str,
+    user_id: int,
+    description: str,
+    base_version: Optional[int] = None,
+    base_data: Optional[str] = None,
+) -> WorkflowSnapshot:
+    """
+    Snapshot for `version`. Stores a JSON Patch against base_version unless this
+    is a keyframe version, there is no base, or the patch would not be smaller.
+    """
+    snapshot = WorkflowSnapshot(
+        chat_id=chat_id,
+        version=version,
+        data=data,
+        description=description,
+        created_by=user_id,
+    )
+    if base_version is None or base_data is None or (version - 1) % SNAPSHOT_KEYFRAME_INTERVAL == 0:
+        return snapshot
+    try:
+        patch = jsonpatch.make_patch(orjson.loads(base_data), orjson.loads(data)).to_string()
+    except (ValueError, TypeError):
+        return snapshot
+    if len(patch) < len(data):
+        snapshot.data = patch
+        snapshot.base_version = base_version
+    return snapshot
+
+
+def snapshot_data(snapshot: WorkflowSnapshot, db: Session) -> str:
+    """Full workflow JSON for a snapshot, replaying patches from its keyframe."""
+    if snapshot.base_version is None:
+        return snapshot.data
+
+    # A write never truncates below its base, so the chain cannot skip the
+    # newest keyframe under this version.
+    keyframe = (
+        select(func.max(WorkflowSnapshot.version))
+        .where(
+            WorkflowSnapshot.chat_id == snapshot.chat_id,
+            WorkflowSnapshot.base_version.is_(None),
+            WorkflowSnapshot.version < snapshot.version,
+        )
+        .scalar_subquery()
+    )
+    rows = {
+        version: (base_version, data)
+        for version, base_version, data in db.query(
+            WorkflowSnapshot.version, WorkflowSnapshot.base_version, WorkflowSnapshot.data
+        ).filter(
+            WorkflowSnapshot.chat_id == snapshot.chat_id,
+            WorkflowSnapshot.version >= keyframe,
+            WorkflowSnapshot.version < snapshot.version,
+        )
+    }
+
+    patches = [snapshot.data]
+    base_version = snapshot.base_version
+    while True:
+        base_version, data = rows[base_version]
+        if base_version is None:
+            break
+        patches.append(data)
+
+    doc = orjson.loads(data)
+    for patch in reversed(patches):
+        doc = jsonpatch.apply_patch(doc, orjson.loads(patch), in_place=True)
+    return orjson.dumps(doc).decode()
 
 
 def ensure_workflow_state(
@@ -11,22 +94,37 @@ def ensure_workflow_state(
     user_id: int,
     db: Session,
     description: str = "AI-generated workflow",
+    commit: bool = True,
 ) -> WorkflowState:
     """
     Create or update WorkflowState and save a snapshot.
     Truncate future snapshots if pointer was in the middle (git-style).
+    With commit=False the changes are only flushed and the caller owns the
+    transaction (and must update or invalidate workflow_state_cache once
+    committed).
     """
-    state = db.query(WorkflowState).filter(WorkflowState.chat_id == chat_id).first()
+    # Locked read: version is bumped read-modify-write, so concurrent writers
+    # (AI replies, operations) must serialize on the row.
+    state = (
+        db.query(WorkflowState)
+        .filter(WorkflowState.chat_id == chat_id)
+        .with_for_update()
+        .first()
+    )
+    base_version = base_data = None
     if state:
-        db.query(WorkflowSnapshot).filter(
-            WorkflowSnapshot.chat_id == chat_id,
-            WorkflowSnapshot.version > state.current_version,
-        ).delete(synchronize_session=False)
+        base_version, base_data = state.current_version, state.data
+        if state.current_version < state.version:
+            db.query(WorkflowSnapshot).filter(
+                WorkflowSnapshot.chat_id == chat_id,
+                WorkflowSnapshot.version > state.current_version,
+            ).delete(synchronize_session=False)
 
         state.version += 1
         state.current_version = state.version
         state.data = data
         state.updated_by = user_id
+        state.updated_at = datetime.utcnow()
     else:
         state = WorkflowState(
             chat_id=chat_id,
@@ -34,18 +132,18 @@ def ensure_workflow_state(
             current_version=1,
             data=data,
             updated_by=user_id,
+            updated_at=datetime.utcnow(),
         )
         db.add(state)
         db.flush()
 
-    snapshot = WorkflowSnapshot(
-        chat_id=chat_id,
-        version=state.version,
-        data=data,
-        description=description,
-        created_by=user_id,
-    )
-    db.add(snapshot)
+    db.add(build_snapshot(chat_id, state.version, data, user_id, description, base_version, base_data))
+    if not commit:
+        db.flush()
+        return state
+    # Every column is known locally (updated_at is set above), so the cache
+    # is filled without re-reading the row the commit just expired.
+    fresh = workflow_state_cache.row_values(state)
     db.commit()
-    db.refresh(state)
+    workflow_state_cache.set(chat_id, fresh)
     return state
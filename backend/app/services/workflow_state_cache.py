@@ -0,0 +1,52 @@
+"""Write-through in-process cache of WorkflowState rows, keyed by chat_id."""
+
+import time
+from typing import Dict, Optional, Tuple
+
+from app.models import WorkflowState
+
+
+class WorkflowStateCache:
+    """
+    Holds a plain-dict copy of each chat's WorkflowState so read paths can
+    skip the SELECT. Every writer either stores the fresh row here after it
+    commits or invalidates the entry; the TTL bounds staleness otherwise.
+    """
+
+    def __init__(self, ttl_seconds: int = 300):
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[int, Tuple[float, dict]] = {}
+
+    def get(self, chat_id: int) -> Optional[dict]:
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return None
+        stored_at, state = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            self._entries.pop(chat_id, None)
+            return None
+        return dict(state)
+
+    def set(self, chat_id: int, state: dict) -> dict:
+        self._entries[chat_id] = (time.monotonic(), dict(state))
+        return state
+
+    def set_from_row(self, state: WorkflowState) -> dict:
+        return self.set(state.chat_id, self.row_values(state))
+
+    @staticmethod
+    def row_values(state: WorkflowState) -> dict:
+        """Plain-dict copy of a row; take it before commit to avoid a reload."""
+        return {
+            "version": state.version,
+            "current_version": state.current_version,
+            "data": state.data,
+            "updated_by": state.updated_by,
+            "updated_at": state.updated_at,
+        }
+
+    def invalidate(self, chat_id: int) -> None:
+        self._entries.pop(chat_id, None)
+
+
+workflow_state_cache = WorkflowStateCache()
@@ -4,10 +4,11 @@ Conflict Resolution Engine for Collaborative Workflow Editing.
 Version-based optimistic concurrency with operation-level merging.
 """
 
-import json
 from typing import List, Dict
 from dataclasses import dataclass, field
 
+import orjson
+
 
 @dataclass
 class Operation:
@@ -137,26 +138,26 @@ def resolve(
     incoming_ops: List[Operation],
     op_log: List[dict],
 ) -> ConflictResult:
-    workflow = json.loads(current_data)
+    workflow = orjson.loads(current_data)
 
     if base_version == current_version:
         updated = apply_operations(workflow, incoming_ops)
         return ConflictResult(
             status="applied",
             new_version=current_version + 1,
-            new_data=json.dumps(updated),
+            new_data=orjson.dumps(updated).decode(),
         )
 
     concurrent_ops = []
     for entry in op_log:
         try:
-            ops_data = json.loads(entry.get("op_data", "[]"))
+            ops_data = orjson.loads(entry.get("op_data", "[]"))
             if isinstance(ops_data, list):
                 for od in ops_data:
                     concurrent_ops.append(Operation(op_type=od.get("op_type", ""), payload=od.get("payload", {})))
             else:
                 concurrent_ops.append(Operation(op_type=ops_data.get("op_type", ""), payload=ops_data.get("payload", {})))
-        except (json.JSONDecodeError, AttributeError):
+        except (orjson.JSONDecodeError, AttributeError):
             pass
 
     conflicts = detect_conflicts(incoming_ops, concurrent_ops)
@@ -164,4 +165,4 @@ def resolve(
         return ConflictResult(status="conflict", new_version=current_version, new_data=current_data, conflicts=conflicts)
 
     updated = apply_operations(workflow, incoming_ops)
-    return ConflictResult(status="merged", new_version=current_version + 1, new_data=json.dumps(updated))
+    return ConflictResult(status="merged", new_version=current_version + 1, new_data=orjson.dumps(updated).decode())
@@ -8,7 +8,40 @@ is finished.
 """
 
 import json
-from typing import List, Dict, Set, Tuple
+import re
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+# Inside an object but outside strings these are the only characters that
+# change scan state; the regex engine skips everything between them.
+_RE_STRUCT = re.compile(rb'[{}"]')
+_LBRACE, _RBRACE = b"{}"
+# Rest of a string literal: the body with any escapes, then the closing
+# quote if it has arrived (group 1 is empty while the string is still open).
+_RE_STRING_REST = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*("?)', re.DOTALL)
+
+# JSONDecoder holds no per-call state, so every parser shares one instance
+# (and its C scanner) rather than building one per stream.
+_DECODER = json.JSONDecoder()
+
+_NODE_REQ = frozenset(("id", "label", "type"))
+_EDGE_REQ = frozenset(("from", "to"))
+_NODE_ONLY = frozenset(("id",))
+
+
+def _may_be_item(buf: bytearray, start: int, end: int) -> bool:
+    """Cheap substring test: could buf[start:end] decode to a node or edge?"""
+    if buf.find(b'"id"', start, end) >= 0:
+        return buf.find(b'"label"', start, end) >= 0
+    return buf.find(b'"from"', start, end) >= 0 and buf.find(b'"to"', start, end) >= 0
+
+
+def _as_str(value) -> str:
+    # Decoded strings pass through untouched; ids may arrive as numbers.
+    return value if type(value) is str else str(value)
+
+
+def _all_str(obj: Dict) -> bool:
+    return all(type(value) is str for value in obj.values())
 
 
 class IncrementalWorkflowParser:
@@ -21,12 +54,41 @@ class IncrementalWorkflowParser:
       - Edges in any key order: {"from","to"} or {"to","from"}
       - JSON inside markdown code blocks (```json ... ```)
       - Nodes/edges with extra keys (ignored gracefully)
+      - Nodes/edges at any nesting depth; every completed object is checked,
+        not just innermost ones
+
+    feed_iter() is the only place parser state changes: it advances the scan
+    and records each new node/edge in the dedup sets and running lists at
+    once, before returning, so a caller that never iterates its result loses
+    nothing. feed() and the get_all_* accessors just read those results.
     """
 
+    # One parser per streamed reply; slots drop the per-instance __dict__.
+    __slots__ = (
+        "_buf",
+        "_scan_pos",
+        "_open_starts",
+        "_in_string",
+        "_emitted_node_ids",
+        "_emitted_edge_keys",
+        "_all_nodes",
+        "_all_edges",
+        "_workflow_json",
+    )
+
     def __init__(self):
-        self.buffer: str = ""
+        # UTF-8 bytes of the stream; bytearray appends are amortized O(1)
+        # where `str +=` on an attribute copies the whole buffer every feed.
+        self._buf = bytearray()
+        # Scan state carried between feeds so each one only reads new text.
+        self._scan_pos = 0
+        self._open_starts: List[int] = []
+        self._in_string = False
         self._emitted_node_ids: Set[str] = set()
-        self._emitted_edge_keys: Set[str] = set()
+        self._emitted_edge_keys: Set[Tuple[str, str]] = set()
+        self._all_nodes: List[Dict] = []
+        self._all_edges: List[Dict] = []
+        self._workflow_json: Optional[str] = None
 
     def feed(self, chunk: str) -> Tuple[List[Dict], List[Dict]]:
         """
@@ -38,129 +100,159 @@ class IncrementalWorkflowParser:
             new_nodes : list of {"id", "label", "type"} dicts
             new_edges : list of {"from", "to"} dicts
         """
-        self.buffer += chunk
-        new_nodes: List[Dict] = []
-        new_edges: List[Dict] = []
+        node_count = len(self._all_nodes)
+        edge_count = len(self._all_edges)
+        self.feed_iter(chunk)
+        # feed_iter records every item in the running lists; this feed's
+        # results are just their new tails.
+        return self._all_nodes[node_count:], self._all_edges[edge_count:]
 
-        for obj in self._extract_leaf_objects():
+    def feed_iter(self, chunk: str) -> Iterator[Tuple[str, Dict]]:
+        """
+        Feed a new chunk and return an iterator over the ("node", node) /
+        ("edge", edge) pairs it completed, in stream order, for callers that
+        write each one straight out. The chunk is buffered and scanned here,
+        not when the iterator is consumed.
+        """
+        self._buf += chunk.encode()
+        if "}" not in chunk:
+            # Nothing can complete without a closing brace. The cursor stays
+            # put, so the next chunk that has one scans this text too.
+            return iter(())
+        items: List[Tuple[str, Dict]] = []
+        for obj in self._extract_objects():
             if self._is_node(obj):
-                node_id = str(obj["id"])
+                node_id = _as_str(obj["id"])
                 if node_id not in self._emitted_node_ids:
                     self._emitted_node_ids.add(node_id)
-                    new_nodes.append({
-                        "id": node_id,
-                        "label": str(obj["label"]),
-                        "type": str(obj["type"]),
-                    })
+                    if len(obj) == 3 and _all_str(obj):
+                        # Already exactly a node: reuse the decoded dict.
+                        node = obj
+                    else:
+                        node = {
+                            "id": node_id,
+                            "label": _as_str(obj["label"]),
+                            "type": _as_str(obj["type"]),
+                        }
+                    self._all_nodes.append(node)
+                    items.append(("node", node))
             elif self._is_edge(obj):
-                key = f"{obj['from']}->{obj['to']}"
+                key = (_as_str(obj["from"]), _as_str(obj["to"]))
                 if key not in self._emitted_edge_keys:
                     self._emitted_edge_keys.add(key)
-                    new_edges.append({
-                        "from": str(obj["from"]),
-                        "to": str(obj["to"]),
-                    })
-
-        return new_nodes, new_edges
+                    if len(obj) == 2 and _all_str(obj):
+                        edge = obj
+                    else:
+                        edge = {"from": key[0], "to": key[1]}
+                    self._all_edges.append(edge)
+                    items.append(("edge", edge))
+        return iter(items)
 
     def get_all_nodes(self) -> List[Dict]:
-        """Return all nodes detected so far, in emission order."""
-        result = []
-        seen = set()
-        for obj in self._extract_leaf_objects():
-            if self._is_node(obj):
-                nid = str(obj["id"])
-                if nid not in seen:
-                    seen.add(nid)
-                    result.append({
-                        "id": nid,
-                        "label": str(obj["label"]),
-                        "type": str(obj["type"]),
-                    })
-        return result
+        """Return all nodes detected so far, in emission order (a copy; no rescan)."""
+        return list(self._all_nodes)
 
     def get_all_edges(self) -> List[Dict]:
-        """Return all edges detected so far."""
-        result = []
-        seen = set()
-        for obj in self._extract_leaf_objects():
-            if self._is_edge(obj):
-                key = f"{obj['from']}->{obj['to']}"
-                if key not in seen:
-                    seen.add(key)
-                    result.append({
-                        "from": str(obj["from"]),
-                        "to": str(obj["to"]),
-                    })
-        return result
+        """Return all edges detected so far, in emission order (a copy; no rescan)."""
+        return list(self._all_edges)
+
+    def finalize(self) -> Optional[str]:
+        """
+        Return the complete workflow JSON text seen in the stream, or None.
+
+        Only set once a whole {"nodes": [...], "edges": [...]} object with at
+        least one node has been parsed, so callers can skip re-extraction.
+        """
+        return self._workflow_json
 
     @staticmethod
-    def _is_node(obj: Dict) -> bool:
+    def _is_workflow(obj: Dict) -> bool:
         return (
             isinstance(obj, dict)
-            and "id" in obj
-            and "label" in obj
-            and "type" in obj
+            and isinstance(obj.get("nodes"), list)
+            and isinstance(obj.get("edges"), list)
+            and len(obj["nodes"]) > 0
         )
 
+    # Decoded JSON objects are always exact dicts, so `type(...) is dict`
+    # suffices, and the key-view comparison runs as one C-level subset test.
+    @staticmethod
+    def _is_node(obj: Dict) -> bool:
+        return type(obj) is dict and obj.keys() >= _NODE_REQ
+
     @staticmethod
     def _is_edge(obj: Dict) -> bool:
         return (
-            isinstance(obj, dict)
-            and "from" in obj
-            and "to" in obj
-            and "id" not in obj
+            type(obj) is dict
+            and obj.keys() >= _EDGE_REQ
+            and obj.keys().isdisjoint(_NODE_ONLY)
         )
 
-    def _extract_leaf_objects(self) -> List[Dict]:
-        """Scan the buffer for complete JSON leaf objects (node/edge candidates)."""
+    def _extract_objects(self) -> List[Dict]:
+        """
+        Scan the text appended since the last call for newly completed JSON
+        objects at any depth. Nested ones are decoded only if `_may_be_item`
+        says they could be a node or edge; top-level ones are always decoded,
+        since one may be the whole workflow. Open braces and string state
+        persist between calls, so objects inside a still-open workflow are
+        found as soon as they close and the stream is read once.
+        """
         objects: List[Dict] = []
-        text = self.buffer
-        i = 0
-        length = len(text)
-
-        while i < length:
-            if text[i] == "{":
-                depth = 1
-                j = i + 1
-                while j < length and depth > 0:
-                    ch = text[j]
-                    if ch == "{":
-                        depth += 1
-                    elif ch == "}":
-                        depth -= 1
-                    elif ch == '"':
-                        j += 1
-                        while j < length and text[j] != '"':
-                            if text[j] == "\\":
-                                j += 1
-                            j += 1
-                    j += 1
-
-                if depth == 0:
-                    candidate = text[i:j]
-                    inner = candidate[1:-1]
-                    if self._has_no_nested_braces(inner):
-                        try:
-                            obj = json.loads(candidate)
-                            if isinstance(obj, dict):
-                                objects.append(obj)
-                        except (json.JSONDecodeError, ValueError):
-                            pass
-                    i = j
-                else:
+        buf = self._buf
+        starts = self._open_starts
+        in_string = self._in_string
+        pos = self._scan_pos
+        end = len(buf)
+
+        while pos < end:
+            if in_string:
+                # One C-level match to the closing quote, escapes included.
+                match = _RE_STRING_REST.match(buf, pos)
+                pos = match.end()
+                if not match.group(1):
+                    # Still open; a trailing backslash waits for its byte.
                     break
+                in_string = False
+                continue
+            if not starts:
+                # Outside any object (prose, the ```json fence) only an
+                # opening brace matters: jump straight to it.
+                i = buf.find(b"{", pos)
+                if i < 0:
+                    pos = end
+                    break
+                starts.append(i)
+                pos = i + 1
+                continue
+            match = _RE_STRUCT.search(buf, pos)
+            if match is None:
+                pos = end
+                break
+            i = match.start()
+            pos = i + 1
+            ch = buf[i]
+            if ch == _LBRACE:
+                starts.append(i)
+            elif ch == _RBRACE:
+                start = starts.pop()
+                # Nested objects only matter as nodes/edges; skip decoding
+                # any that can't be one. Top-level ones may be the workflow.
+                if starts and not _may_be_item(buf, start, i):
+                    continue
+                # Braces are ASCII, so the span always decodes cleanly.
+                candidate = buf[start:i + 1].decode()
+                try:
+                    obj = _DECODER.decode(candidate)
+                except ValueError:
+                    continue
+                if not isinstance(obj, dict):
+                    continue
+                objects.append(obj)
+                if not starts and self._workflow_json is None and self._is_workflow(obj):
+                    self._workflow_json = candidate
             else:
-                i += 1
+                in_string = True
 
+        self._scan_pos = pos
+        self._in_string = in_string
         return objects
-
-    @staticmethod
-    def _has_no_nested_braces(inner: str) -> bool:
-        in_string = False
-        for i, ch in enumerate(inner):
-            if ch == '"' and (i == 0 or inner[i - 1] != "\\"):
-                in_string = not in_string
-            elif not in_string and ch in "{}":
-                return False
-        return True
@@ -1,10 +1,14 @@
 """WebSocket connection and per-chat lock management."""
 
 import asyncio
-from typing import Dict
+from typing import Dict, Set
 
+import orjson
 from fastapi import WebSocket
 
+# Sockets sent to concurrently per batch in broadcast_to_chat.
+BROADCAST_BATCH_SIZE = 50
+
 
 class ConnectionManager:
     """Manages WebSocket connections per chat room with presence tracking."""
@@ -12,6 +16,7 @@ class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[int, Dict[int, WebSocket]] = {}
         self.user_info: Dict[int, Dict[int, dict]] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
 
     async def connect(self, websocket: WebSocket, chat_id: int, user_id: int, username: str):
         await websocket.accept()
@@ -33,17 +38,34 @@ class ConnectionManager:
     async def broadcast_to_chat(self, chat_id: int, message: dict, exclude_user: int | None = None):
         if chat_id not in self.active_connections:
             return
+        recipients = [
+            (uid, ws) for uid, ws in self.active_connections[chat_id].items() if uid != exclude_user
+        ]
+        if not recipients:
+            return
+        # Encode once; every recipient gets the same text frame.
+        frame = orjson.dumps(message).decode()
         disconnected = []
-        for uid, ws in self.active_connections[chat_id].items():
-            if uid == exclude_user:
-                continue
-            try:
-                await ws.send_json(message)
-            except Exception:
-                disconnected.append(uid)
+        for start in range(0, len(recipients), BROADCAST_BATCH_SIZE):
+            if start:
+                await asyncio.sleep(0)  # let other tasks run between batches
+            batch = recipients[start:start + BROADCAST_BATCH_SIZE]
+            results = await asyncio.gather(
+                *(ws.send_text(frame) for _, ws in batch), return_exceptions=True
+            )
+            disconnected.extend(
+                uid for (uid, _), res in zip(batch, results) if isinstance(res, Exception)
+            )
         for uid in disconnected:
             self.disconnect(chat_id, uid)
 
+    def broadcast_in_background(self, chat_id: int, message: dict, exclude_user: int | None = None):
+        """Schedule broadcast_to_chat without awaiting it so slow sockets stay off the request path."""
+        task = asyncio.create_task(self.broadcast_to_chat(chat_id, message, exclude_user))
+        # Hold a reference until done; the loop only keeps weak refs to tasks.
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
     async def broadcast_presence(self, chat_id: int):
         if chat_id not in self.user_info:
             return
@@ -70,6 +70,15 @@ export const streamApi = {
                 case 'edge_add':
                   callbacks.onEdgeAdd?.(data as { edge: { from: string; to: string } });
                   break;
+                case 'graph_delta': {
+                  const delta = data as {
+                    nodes: { id: string; label: string; type: string }[];
+                    edges: { from: string; to: string }[];
+                  };
+                  for (const node of delta.nodes) callbacks.onNodeAdd?.({ node });
+                  for (const edge of delta.edges) callbacks.onEdgeAdd?.({ edge });
+                  break;
+                }
                 case 'workflow_complete':
                   callbacks.onWorkflowComplete?.(data as {
                     workflow_data: string | null;
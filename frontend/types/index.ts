@@ -25,6 +25,7 @@ export interface Message {
 
 export interface ChatWithMessages extends Chat {
   messages: Message[];
+  has_more: boolean;
 }
 
 export interface Collaborator {